@@ -1,12 +1,189 @@
+import copy
+import re
+
+from django import forms
+from django.conf import settings
 from django.contrib import admin
+from django.contrib.admin.options import IncorrectLookupParameters
+from django.contrib.admin.views.main import ChangeList
+from django.core.paginator import EmptyPage, InvalidPage, Page, PageNotAnInteger, Paginator
+from django.db import connection
+from django.db.models.sql.datastructures import EmptyResultSet
+from django.forms.models import construct_instance
 
-from cal.models import Calendar, Entry
+from cal.models import Calendar, Entry, EntryException, EntrySearchToken, tokenize
 from panya.admin import ModelBaseAdmin
 
+def estimated_count(queryset):
+    """
+    Returns the number of rows in queryset's table as estimated from database statistics,
+    or None if the database doesn't provide an estimate.
+    """
+    table = queryset.model._meta.db_table
+    cursor = connection.cursor()
+    if connection.vendor == 'postgresql':
+        cursor.execute("SELECT reltuples FROM pg_class WHERE relname = %s", [table])
+    elif connection.vendor == 'mysql':
+        cursor.execute("SELECT table_rows FROM information_schema.tables WHERE table_schema = DATABASE() AND table_name = %s", [table])
+    else:
+        return None
+    row = cursor.fetchone()
+    return int(row[0]) if row and row[0] is not None else None
+
+def planned_count(queryset):
+    """
+    Returns the number of objects in queryset as estimated by the database's query planner,
+    or None if the database doesn't provide an estimate.
+    """
+    if connection.vendor not in ('postgresql', 'mysql'):
+        return None
+    sql, params = queryset.order_by().query.sql_with_params()
+    cursor = connection.cursor()
+    cursor.execute("EXPLAIN " + sql, params)
+    row = cursor.fetchone()
+    if connection.vendor == 'postgresql':
+        match = re.search(r'rows=(\d+)', row[0])
+        return int(match.group(1)) if match else None
+    rows = row[[column[0] for column in cursor.description].index('rows')]
+    return int(rows) if rows is not None else None
+
+def approximate_count(queryset):
+    """
+    Returns the number of objects in queryset, counting exactly up to settings.CAL_ADMIN_COUNT_LIMIT
+    objects (10000 by default). Beyond that counts are estimated from database statistics or the query
+    planner where the database provides them, and counted in full otherwise.
+    """
+    limit = getattr(settings, 'CAL_ADMIN_COUNT_LIMIT', 10000)
+    if not queryset.query.where:
+        estimate = estimated_count(queryset)
+        if estimate is not None and estimate > limit:
+            return estimate
+    # counting a limited subquery stops scanning once the limit is reached
+    try:
+        sql, params = queryset.order_by().values('pk')[:limit].query.sql_with_params()
+    except EmptyResultSet:
+        return 0
+    cursor = connection.cursor()
+    cursor.execute("SELECT COUNT(*) FROM (%s) limited" % sql, params)
+    count = cursor.fetchone()[0]
+    if count < limit:
+        return count
+    estimate = planned_count(queryset)
+    if estimate is not None:
+        return max(limit, estimate)
+    return queryset.count()
+
+class ApproximateCountPaginator(Paginator):
+    """
+    Paginator for approximate counts. Pages beyond the counted number of pages are served
+    as long as they contain objects, so estimates that fall short don't hide any objects.
+    """
+    def _get_count(self):
+        if self._count is None:
+            self._count = approximate_count(self.object_list)
+        return self._count
+    count = property(_get_count)
+
+    def validate_number(self, number):
+        try:
+            number = int(number)
+        except (TypeError, ValueError):
+            raise PageNotAnInteger('That page number is not an integer')
+        if number < 1:
+            raise EmptyPage('That page number is less than 1')
+        return number
+
+    def page(self, number):
+        number = self.validate_number(number)
+        bottom = (number - 1) * self.per_page
+        object_list = self.object_list[bottom:bottom + self.per_page]
+        if number > 1 and not len(object_list):
+            raise EmptyPage('That page contains no results')
+        return Page(object_list, number, self)
+
+class EntryChangeList(ChangeList):
+    def get_query_set(self, *args, **kwargs):
+        # search the entry search token index rather than LIKE '%term%' over joined content
+        query = self.query
+        self.query = ''
+        try:
+            queryset = super(EntryChangeList, self).get_query_set(*args, **kwargs)
+        finally:
+            self.query = query
+        for token in tokenize(query):
+            queryset = queryset.filter(id__in=EntrySearchToken.objects.filter(token=token).values('entry'))
+        return queryset
+
+    def get_results(self, request):
+        # as ChangeList.get_results, but without counting the full result set exactly
+        paginator = self.model_admin.get_paginator(request, self.query_set, self.list_per_page)
+        result_count = paginator.count
+        if not self.query_set.query.where:
+            full_result_count = result_count
+        else:
+            full_result_count = approximate_count(self.root_query_set)
+
+        can_show_all = result_count <= self.list_max_show_all
+        multi_page = result_count > self.list_per_page
+        if (self.show_all and can_show_all) or not multi_page:
+            result_list = self.query_set._clone()
+        else:
+            try:
+                result_list = paginator.page(self.page_num + 1).object_list
+            except InvalidPage:
+                raise IncorrectLookupParameters
+
+        self.result_count = result_count
+        self.full_result_count = full_result_count
+        self.result_list = result_list
+        self.can_show_all = can_show_all
+        self.multi_page = multi_page
+        self.paginator = paginator
+
+class EntryAdminForm(forms.ModelForm):
+    class Meta():
+        model = Entry
+
+    def clean(self):
+        cleaned_data = super(EntryAdminForm, self).clean()
+        # check submitted calendars for conflicts, the entry's own aren't saved yet, see Entry.conflicts
+        if getattr(settings, 'CAL_CHECK_CONFLICTS', False) and not self._errors:
+            entry = construct_instance(self, copy.copy(self.instance))
+            conflicts = entry.conflicts(calendars=cleaned_data.get('calendars', []))
+            if conflicts:
+                raise forms.ValidationError("Entry overlaps %s on its calendars, starting %s." % (conflicts[0], conflicts[0].start))
+        return cleaned_data
+
+class EntryExceptionInline(admin.TabularInline):
+    model = EntryException
+    extra = 0
+
 class EntryAdmin(admin.ModelAdmin):
-    list_display = ('content', 'start', 'end', 'repeat', 'repeat_until')
-    list_filter = ('repeat',)
+    form = EntryAdminForm
+    list_display = ('content', 'start', 'end', 'repeat', 'repeat_until', 'materialization_status')
+    list_filter = ('repeat', 'materialization_status')
+    # searched through EntrySearchToken, see EntryChangeList
     search_fields = ('content__title', 'content__description')
+    date_hierarchy = 'start'
+    inlines = (EntryExceptionInline,)
+    list_select_related = True
+    paginator = ApproximateCountPaginator
+
+    def queryset(self, request):
+        # the changelist shows content but no calendars, so only join content
+        return super(EntryAdmin, self).queryset(request).select_related('content')
+
+    def get_changelist(self, request, **kwargs):
+        return EntryChangeList
+
+    def save_model(self, request, obj, form, change):
+        # conflicts were checked by the form, with the submitted calendars,
+        # and entry items are synced once calendars and exceptions are saved
+        obj.save(check_conflicts=False, sync=False)
+
+    def save_related(self, request, form, formsets, change):
+        super(EntryAdmin, self).save_related(request, form, formsets, change)
+        form.instance.sync()
 
 admin.site.register(Calendar, ModelBaseAdmin)
 admin.site.register(Entry, EntryAdmin)
@@ -0,0 +1,219 @@
+"""
+Synthetic data and measurement helpers used by the benchmark_calendar management command.
+Benchmarks report wall time and query counts and can be stored as a baseline to compare later runs against.
+Synthetic data is published on the current site and cleaned up by title, so the command runs these against
+a throwaway test database unless told otherwise.
+"""
+import json
+import random
+import time
+from datetime import datetime, timedelta
+
+from django.conf import settings
+from django.db import connection
+
+from cal.managers import EntryItemQuerySet
+from cal.models import Calendar, Entry, EntryItem, EntryItemVisibility
+from panya.models import ModelBase
+
+BENCHMARK_TITLE = 'cal benchmark'
+
+HANDLER_REPEATS = ('does_not_repeat', 'daily', 'weekdays', 'weekends', 'weekly', 'monthly_by_day_of_month', 'monthly_by_day_of_week', 'monthly_by_last_day_of_week', 'monthly_by_last_day_of_month', 'yearly')
+
+HORIZONS = (
+    ('1 month', 30),
+    ('1 year', 365),
+    ('5 years', 365 * 5),
+)
+
+def create_calendar():
+    """
+    Creates a published benchmark calendar on the current site.
+    """
+    calendar = Calendar(title=BENCHMARK_TITLE, state='published')
+    calendar.save()
+    calendar.sites.add(settings.SITE_ID)
+    return calendar
+
+def create_content():
+    """
+    Creates published benchmark content on the current site.
+    """
+    content = ModelBase(title=BENCHMARK_TITLE, state='published')
+    content.save()
+    content.sites.add(settings.SITE_ID)
+    return content
+
+def populate(count, start=None, days=365*5, batch_size=10000, seed=0):
+    """
+    Bulk creates count entry items of up to a day long, randomly spread over days from start,
+    all linked to a single benchmark entry on a published benchmark calendar visible on the current site.
+    """
+    if start is None:
+        start = datetime.now() - timedelta(days=days / 2)
+    generator = random.Random(seed)
+
+    calendar = create_calendar()
+    content = create_content()
+    entry = Entry(start=start, end=start + timedelta(hours=1), content=content)
+    entry.save()
+    entry.calendars.add(calendar)
+    entry.save()
+
+    through = EntryItem.calendars.through
+    seconds = days * 24 * 60 * 60
+    created = 0
+    last_id = max(entry.entryitem_set.values_list('id', flat=True))
+    while created < count:
+        entry_items = []
+        for i in range(min(batch_size, count - created)):
+            item_start = start + timedelta(seconds=generator.randint(0, seconds))
+            item_end = item_start + timedelta(minutes=generator.randint(1, 24 * 60))
+            entry_items.append(EntryItem(start=item_start, end=item_end, entry=entry, content=content, content_type_id=entry.content_type_id))
+        EntryItem.objects.bulk_create(entry_items)
+        created += len(entry_items)
+
+        # link and publish the new items directly, we know they are visible
+        entryitem_ids = list(entry.entryitem_set.filter(id__gt=last_id).values_list('id', flat=True))
+        through.objects.bulk_create([through(entryitem_id=entryitem_id, calendar_id=calendar.id) for entryitem_id in entryitem_ids])
+        EntryItemVisibility.objects.bulk_create([EntryItemVisibility(entryitem_id=entryitem_id, site_id=settings.SITE_ID) for entryitem_id in entryitem_ids])
+        last_id = max(entryitem_ids)
+    return entry
+
+def cleanup():
+    """
+    Removes all benchmark data. Uses raw deletes since collecting millions of entry items is prohibitively slow.
+    """
+    entry_ids = list(Entry.objects.filter(content__title=BENCHMARK_TITLE).values_list('id', flat=True))
+    if entry_ids:
+        cursor = connection.cursor()
+        placeholders = ', '.join(['%s'] * len(entry_ids))
+        for table in (EntryItem.calendars.through._meta.db_table, EntryItemVisibility._meta.db_table):
+            cursor.execute("DELETE FROM %s WHERE entryitem_id IN (SELECT id FROM %s WHERE entry_id IN (%s))" % (table, EntryItem._meta.db_table, placeholders), entry_ids)
+        cursor.execute("DELETE FROM %s WHERE entry_id IN (%s)" % (EntryItem._meta.db_table, placeholders), entry_ids)
+        Entry.objects.filter(id__in=entry_ids).delete()
+    Calendar.objects.filter(title=BENCHMARK_TITLE).delete()
+    ModelBase.objects.filter(title=BENCHMARK_TITLE).delete()
+
+def explain(queryset):
+    """
+    Returns the database's query plan for queryset as a list of lines.
+    """
+    sql, params = queryset.query.get_compiler(queryset.db).as_sql()
+    if connection.vendor == 'sqlite':
+        sql = 'EXPLAIN QUERY PLAN ' + sql
+    else:
+        sql = 'EXPLAIN ' + sql
+    cursor = connection.cursor()
+    cursor.execute(sql, params)
+    return [' '.join([unicode(column) for column in row]) for row in cursor.fetchall()]
+
+def measure(func, repeat=5):
+    """
+    Calls func repeat times, returning the fastest and mean wall times in seconds.
+    """
+    timings = []
+    for i in range(repeat):
+        start = time.time()
+        func()
+        timings.append(time.time() - start)
+    return min(timings), sum(timings) / len(timings)
+
+def count_queries(func):
+    """
+    Calls func once, returning the number of queries it executed.
+    """
+    use_debug_cursor = connection.use_debug_cursor
+    connection.use_debug_cursor = True
+    try:
+        start_count = len(connection.queries)
+        func()
+        return len(connection.queries) - start_count
+    finally:
+        connection.use_debug_cursor = use_debug_cursor
+
+def result(name, func, repeat=5):
+    fastest, mean = measure(func, repeat=repeat)
+    return {'name': name, 'fastest': fastest, 'mean': mean, 'queries': count_queries(func)}
+
+def benchmark_handlers(horizons=HORIZONS, repeat=3):
+    """
+    Benchmarks creating and subsequently resaving an entry for each repeat handler across horizons.
+    """
+    results = []
+    calendar = create_calendar()
+    content = create_content()
+    start = datetime(year=2000, month=1, day=1, hour=1)
+    for repeat_name in HANDLER_REPEATS:
+        for horizon_name, days in horizons:
+            def create():
+                entry = Entry(start=start, end=start + timedelta(hours=1), repeat=repeat_name, repeat_until=(start + timedelta(days=days)).date(), content=content)
+                entry.save()
+                entry.calendars.add(calendar)
+                entry.save()
+                return entry
+            name = '%s %s' % (repeat_name, horizon_name)
+            results.append(result('create %s' % name, create, repeat=repeat))
+            entry = create()
+            results.append(result('resave %s' % name, entry.save, repeat=repeat))
+    cleanup()
+    return results
+
+def benchmark_queries(sizes=(10000, 100000, 1000000), repeat=5):
+    """
+    Benchmarks each entry item queryset method, unfiltered and permitted, across synthetic dataset sizes.
+    """
+    results = []
+    for size in sizes:
+        populate(size)
+        now = datetime.now()
+        date = (now + timedelta(days=30)).date()
+        start = now + timedelta(days=30)
+        end = start + timedelta(days=7)
+        for source_name, source in (('queryset', lambda: EntryItemQuerySet(EntryItem)), ('permitted', lambda: EntryItem.permitted)):
+            methods = (
+                ('by_model', lambda: list(source().by_model(ModelBase))),
+                ('by_models', lambda: list(source().by_models(ModelBase, Calendar))),
+                ('now', lambda: list(source().now())),
+                ('by_date', lambda: list(source().by_date(date))),
+                ('by_range', lambda: list(source().by_range(start, end))),
+                ('by_window', lambda: list(source().by_window(start, end))),
+                ('next7days', lambda: list(source().next7days())),
+                ('thisweekend', lambda: list(source().thisweekend())),
+                ('thismonth', lambda: list(source().thismonth())),
+                ('upcoming[:100]', lambda: list(source().upcoming()[:100])),
+                ('week_grid', lambda: source().week_grid(date)),
+                ('month_grid', lambda: source().month_grid(date.year, date.month)),
+            )
+            for method_name, func in methods:
+                results.append(result('%s %s.%s' % (size, source_name, method_name), func, repeat=repeat))
+        cleanup()
+    return results
+
+def save_baseline(results, path):
+    baseline_file = open(path, 'w')
+    try:
+        json.dump(results, baseline_file, indent=4)
+    finally:
+        baseline_file.close()
+
+def load_baseline(path):
+    baseline_file = open(path)
+    try:
+        return dict([(item['name'], item) for item in json.load(baseline_file)])
+    finally:
+        baseline_file.close()
+
+def compare(results, baseline):
+    """
+    Annotates results with their baseline's fastest time and query count, and the ratio of fastest times.
+    """
+    for item in results:
+        base = baseline.get(item['name'])
+        if base is None:
+            continue
+        item['baseline_fastest'] = base['fastest']
+        item['baseline_queries'] = base['queries']
+        if base['fastest']:
+            item['ratio'] = item['fastest'] / base['fastest']
+    return results
@@ -0,0 +1,47 @@
+"""
+Generational caching of calendar query results. Cached values are keyed on a generation
+which is bumped whenever entries, entry items, calendars or content change, invalidating
+all cached results at once without having to track individual keys.
+"""
+import time
+
+from django.conf import settings
+from django.core.cache import cache as default_cache, get_cache
+
+GENERATION_KEY = 'cal:generation'
+GENERATION_TIMEOUT = 60 * 60 * 24 * 30
+
+def get_backend():
+    """
+    Returns the cache backend named by settings.CAL_CACHE_BACKEND, or the default cache.
+    """
+    backend = getattr(settings, 'CAL_CACHE_BACKEND', None)
+    if backend:
+        return get_cache(backend)
+    return default_cache
+
+def new_generation():
+    # time based so a generation evicted from the cache is never reused
+    return int(time.time() * 1000)
+
+def generation():
+    backend = get_backend()
+    value = backend.get(GENERATION_KEY)
+    if value is None:
+        value = new_generation()
+        backend.add(GENERATION_KEY, value, GENERATION_TIMEOUT)
+        value = backend.get(GENERATION_KEY, value)
+    return value
+
+def invalidate():
+    """
+    Invalidates all cached calendar results.
+    """
+    backend = get_backend()
+    try:
+        backend.incr(GENERATION_KEY)
+    except ValueError:
+        backend.set(GENERATION_KEY, new_generation(), GENERATION_TIMEOUT)
+
+def make_key(*parts):
+    return 'cal:%s:%s' % (generation(), ':'.join([str(part) for part in parts]))
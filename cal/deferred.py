@@ -0,0 +1,103 @@
+"""
+Deferred materialization of entry items. With settings.CAL_DEFERRED_MATERIALIZATION set,
+Entry.save only marks the entry as pending and its entry items are written later, either by
+a pool of worker threads in the saving process ('thread') or by the materialize_pending
+management command draining pending entries ('queue'). The management command also picks up
+entries left pending by threads, i.e. when the process exited before they were handled.
+
+Worker threads drain pending rows from the database rather than trusting an in-memory queue of
+ids, as saves usually happen within a transaction the workers can't see into until it commits,
+i.e. the admin's. Saves wake the workers up, and they check for pending entries again every
+settings.CAL_DEFERRED_POLL seconds (5 by default) to pick up entries committed after waking.
+
+An entry's materialization_status moves from pending to running to ready (or failed). Saving an
+entry that is already pending doesn't add another job, and saving one while it is running sets
+it back to pending so its latest state is materialized once the running job finishes.
+"""
+from __future__ import with_statement
+
+import logging
+import threading
+
+from django.conf import settings
+from django.db import connection
+
+logger = logging.getLogger('cal')
+
+# worker threads guarded by lock, woken up by saves through wakeup
+lock = threading.Lock()
+wakeup = threading.Event()
+workers = []
+
+def deferred_mode():
+    """
+    Returns 'thread' or 'queue' if materialization is deferred, otherwise None.
+    """
+    mode = getattr(settings, 'CAL_DEFERRED_MATERIALIZATION', None)
+    if mode not in (None, 'thread', 'queue'):
+        raise Exception("Unknown settings.CAL_DEFERRED_MATERIALIZATION value '%s', use 'thread' or 'queue'." % mode)
+    return mode
+
+def schedule(entry_id):
+    """
+    Wakes up worker threads to materialize pending entry in thread mode, starting them if needed.
+    In queue mode the pending status is left for the materialize_pending management command.
+    """
+    if deferred_mode() != 'thread':
+        return
+    with lock:
+        if not workers:
+            for i in range(getattr(settings, 'CAL_DEFERRED_WORKERS', 2)):
+                worker = threading.Thread(target=work, name='cal-materialize-%s' % i)
+                worker.daemon = True
+                worker.start()
+                workers.append(worker)
+    wakeup.set()
+
+def poll(timeout):
+    """
+    Waits up to timeout seconds for entries to be saved, then materializes pending entries.
+    Returns the number of entries materialized.
+    """
+    wakeup.wait(timeout)
+    # saves from here on wake the workers again
+    wakeup.clear()
+    return run_pending()
+
+def work():
+    while True:
+        try:
+            poll(getattr(settings, 'CAL_DEFERRED_POLL', 5))
+        except Exception:
+            logger.exception("Failed materializing pending entries.")
+        finally:
+            # worker threads have their own connections, don't keep them open while idle
+            connection.close()
+
+def run(entry_id):
+    """
+    Materializes pending entry if it can be claimed, returning True if it was materialized.
+    """
+    from cal.models import Entry
+
+    if not Entry.objects.filter(id=entry_id, materialization_status='pending').update(materialization_status='running'):
+        return False
+    try:
+        Entry.objects.get(id=entry_id).materialize()
+    except Exception:
+        logger.exception("Failed materializing entry items for entry %s." % entry_id)
+        Entry.objects.filter(id=entry_id, materialization_status='running').update(materialization_status='failed')
+        return False
+    Entry.objects.filter(id=entry_id, materialization_status='running').update(materialization_status='ready')
+    return True
+
+def run_pending(limit=None):
+    """
+    Materializes pending entries, oldest first, returning the number of entries materialized.
+    """
+    from cal.models import Entry
+
+    entry_ids = Entry.objects.filter(materialization_status='pending').order_by('id').values_list('id', flat=True)
+    if limit is not None:
+        entry_ids = entry_ids[:limit]
+    return len([entry_id for entry_id in list(entry_ids) if run(entry_id)])
@@ -0,0 +1,72 @@
+import calendar
+from datetime import date as date_cls, datetime, timedelta
+
+class DayBucket(object):
+    """
+    Entry items, or occurrences, overlapping a single day.
+    """
+    def __init__(self, date):
+        self.date = date
+        self.items = []
+
+    @property
+    def count(self):
+        return len(self.items)
+
+def bucket_by_day(items, start_date, days):
+    """
+    Splits items into a DayBucket for each of days starting at start_date,
+    adding items spanning multiple days to each day they overlap.
+    """
+    buckets = [DayBucket(start_date + timedelta(days=i)) for i in range(days)]
+    for item in items:
+        first = max(0, (item.start.date() - start_date).days)
+        # items ending at midnight don't overlap the next day
+        last = min(days - 1, ((item.end - timedelta(microseconds=1)).date() - start_date).days)
+        for i in range(first, max(first, last) + 1):
+            buckets[i].items.append(item)
+    return buckets
+
+def next_month(date):
+    """
+    Returns the first day of the month following date's month.
+    """
+    if date.month == 12:
+        return date_cls(date.year + 1, 1, 1)
+    return date_cls(date.year, date.month + 1, 1)
+
+class PeriodGridMixin(object):
+    """
+    Month, week and agenda grids for classes providing by_range.
+    """
+    def period_grid(self, date, days):
+        """
+        Returns a DayBucket for each of days starting at date, fetched with a single range query.
+        """
+        start = datetime(date.year, date.month, date.day)
+        return bucket_by_day(self.by_range(start, start + timedelta(days=days)), date, days)
+
+    def week_grid(self, date=None):
+        """
+        Returns a DayBucket for each of the seven days starting at date, today by default.
+        """
+        if date is None:
+            date = datetime.now().date()
+        return self.period_grid(date, 7)
+
+    def month_grid(self, year=None, month=None):
+        """
+        Returns a DayBucket for each day of the month, the current month by default.
+        """
+        today = datetime.now().date()
+        year = year or today.year
+        month = month or today.month
+        return self.period_grid(date_cls(year, month, 1), calendar.monthrange(year, month)[1])
+
+    def agenda(self, date=None, days=7):
+        """
+        Returns DayBuckets for the days with entry items of days starting at date, today by default.
+        """
+        if date is None:
+            date = datetime.now().date()
+        return [bucket for bucket in self.period_grid(date, days) if bucket.items]
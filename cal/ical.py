@@ -0,0 +1,439 @@
+"""
+iCalendar (RFC 5545) export and import of entries. Repeating entries are exported as a single event
+with a recurrence rule rather than an event per entry item, and recurrence rules are mapped onto
+entries' repeat settings on import.
+"""
+import calendar
+from datetime import datetime, timedelta
+import hashlib
+import itertools
+import re
+
+from django.conf import settings
+from django.contrib.sites.models import Site
+
+from cal.managers import permitted, virtual_mode
+from cal.models import Calendar, Entry, EntryException, EntryItem, check_repeat
+from panya.models import ModelBase
+
+WEEKDAYS = ['MO', 'TU', 'WE', 'TH', 'FR', 'SA', 'SU']
+
+RRULES = {
+    'daily': 'FREQ=DAILY',
+    'weekdays': 'FREQ=WEEKLY;BYDAY=MO,TU,WE,TH,FR',
+    'weekends': 'FREQ=WEEKLY;BYDAY=SA,SU',
+    'weekly': 'FREQ=WEEKLY',
+    'monthly_by_day_of_month': 'FREQ=MONTHLY;BYMONTHDAY=%(day)s',
+    'monthly_by_day_of_week': 'FREQ=MONTHLY;BYDAY=%(nth)s%(weekday)s',
+    'monthly_by_last_day_of_week': 'FREQ=MONTHLY;BYDAY=-1%(weekday)s',
+    'monthly_by_last_day_of_month': 'FREQ=MONTHLY;BYMONTHDAY=-1',
+    'yearly': 'FREQ=YEARLY',
+}
+
+def permitted_entries():
+    """
+    Returns entries with upcoming permitted occurrences.
+    """
+    if virtual_mode():
+        entries = permitted(Entry.objects.all()).distinct()
+        now = datetime.now()
+        return entries.exclude(repeat='does_not_repeat', end__lte=now).exclude(repeat_until__lt=now.date())
+    return Entry.objects.filter(id__in=EntryItem.permitted.upcoming().values('entry'))
+
+def permitted_calendars():
+    """
+    Returns calendars published on the current site, excluding staging calendars unless in staging mode,
+    following the same rules as cal.managers.permitted.
+    """
+    calendars = Calendar.objects.exclude(state='unpublished').filter(sites__id__exact=settings.SITE_ID)
+    if not getattr(settings, 'STAGING', False):
+        calendars = calendars.exclude(state='staging')
+    return calendars
+
+def escape(text):
+    return text.replace('\\', '\\\\').replace(';', '\\;').replace(',', '\\,').replace('\r\n', '\\n').replace('\n', '\\n')
+
+def format_datetime(value):
+    # entries are stored in local time, so they are exported as floating times
+    return value.strftime('%Y%m%dT%H%M%S')
+
+def fold(line):
+    """
+    Encodes line as UTF-8, folding it into lines of at most 75 octets without splitting characters.
+    """
+    folded = []
+    current = ''
+    for character in unicode(line):
+        encoded = character.encode('utf-8')
+        if len(current) + len(encoded) > 75:
+            folded.append(current)
+            current = ' '
+        current += encoded
+    folded.append(current)
+    return '\r\n'.join(folded) + '\r\n'
+
+def rrule(entry):
+    """
+    Returns the recurrence rule for entry's repeat setting, or None if it doesn't repeat.
+    """
+    if entry.repeat not in RRULES:
+        return None
+    rule = RRULES[entry.repeat] % {
+        'day': entry.start.day,
+        'nth': (entry.start.day - 1) // 7 + 1,
+        'weekday': WEEKDAYS[entry.start.weekday()],
+    }
+    if entry.repeat_every and entry.repeat_every > 1:
+        rule += ';INTERVAL=%s' % entry.repeat_every
+    if entry.repeat_until:
+        rule += ';UNTIL=%s' % format_datetime(datetime(entry.repeat_until.year, entry.repeat_until.month, entry.repeat_until.day, 23, 59, 59))
+    return rule
+
+def event_lines(entry, domain, stamp, exceptions=()):
+    """
+    Yields the content lines of entry's VEVENT, or nothing if entry has no occurrences.
+    Cancelled exceptions are exported as EXDATEs and overridden occurrences as VEVENTs
+    with a RECURRENCE-ID following the entry's VEVENT.
+    """
+    first_starts = list(itertools.islice(entry.occurrence_starts(), 1))
+    if not first_starts:
+        return
+    start = first_starts[0]
+    duration = entry.duration
+    
+    overrides = []
+    yield 'BEGIN:VEVENT'
+    yield 'UID:entry-%s@%s' % (entry.id, domain)
+    yield 'DTSTAMP:%s' % stamp
+    yield 'DTSTART:%s' % format_datetime(start)
+    yield 'DTEND:%s' % format_datetime(start + duration)
+    rule = rrule(entry)
+    if rule:
+        yield 'RRULE:%s' % rule
+    for exception in exceptions:
+        original_start = datetime.combine(exception.date, entry.start.time())
+        if exception.cancelled:
+            yield 'EXDATE:%s' % format_datetime(original_start)
+        else:
+            overrides.append((original_start, exception))
+    yield u'SUMMARY:%s' % escape(entry.content.title or u'')
+    if getattr(entry.content, 'description', None):
+        yield u'DESCRIPTION:%s' % escape(entry.content.description)
+    yield 'END:VEVENT'
+
+    for original_start, exception in overrides:
+        content = exception.content if exception.content_id else entry.content
+        override_start = exception.start or original_start
+        yield 'BEGIN:VEVENT'
+        yield 'UID:entry-%s@%s' % (entry.id, domain)
+        yield 'DTSTAMP:%s' % stamp
+        yield 'RECURRENCE-ID:%s' % format_datetime(original_start)
+        yield 'DTSTART:%s' % format_datetime(override_start)
+        yield 'DTEND:%s' % format_datetime(exception.end or override_start + duration)
+        yield u'SUMMARY:%s' % escape(content.title or u'')
+        if getattr(content, 'description', None):
+            yield u'DESCRIPTION:%s' % escape(content.description)
+        yield 'END:VEVENT'
+
+def feed(entries=None, name=None, chunk_size=100):
+    """
+    Streams an iCalendar feed of entries, permitted upcoming entries by default, in chunks of chunk_size events.
+    Entries are fetched through an iterator so memory use stays flat regardless of calendar size,
+    with the exceptions of each chunk of entries fetched in a single query.
+    """
+    if entries is None:
+        entries = permitted_entries()
+    domain = Site.objects.get_current().domain
+    stamp = datetime.utcnow().strftime('%Y%m%dT%H%M%SZ')
+
+    lines = ['BEGIN:VCALENDAR', 'VERSION:2.0', 'PRODID:-//Praekelt Foundation//panya-calendar//EN', 'CALSCALE:GREGORIAN']
+    if name:
+        lines.append(u'X-WR-CALNAME:%s' % escape(name))
+    chunk = [fold(line) for line in lines]
+    
+    entries = entries.select_related('content').iterator()
+    while True:
+        chunk_entries = list(itertools.islice(entries, chunk_size))
+        if not chunk_entries:
+            break
+        exceptions = {}
+        for exception in EntryException.objects.filter(entry__in=[entry.id for entry in chunk_entries]).select_related('content').order_by('date'):
+            exceptions.setdefault(exception.entry_id, []).append(exception)
+        for entry in chunk_entries:
+            chunk += [fold(line) for line in event_lines(entry, domain, stamp, exceptions.get(entry.id, ()))]
+        yield ''.join(chunk)
+        chunk = []
+    chunk.append(fold('END:VCALENDAR'))
+    yield ''.join(chunk)
+
+def unfold(lines):
+    """
+    Lazily yields logical content lines from an iterable of physical lines, i.e. an open file.
+    """
+    current = None
+    for line in lines:
+        if isinstance(line, str):
+            line = line.decode('utf-8')
+        line = line.rstrip('\r\n')
+        if line.startswith(' ') or line.startswith('\t'):
+            if current is not None:
+                current += line[1:]
+            continue
+        if current is not None:
+            yield current
+        current = line
+    if current:
+        yield current
+
+def parse_line(line):
+    """
+    Splits a content line into its name, parameters and value.
+    """
+    if ':' not in line:
+        raise ValueError("Malformed content line '%s'." % line[:75])
+    name_params, value = line.split(':', 1)
+    parts = name_params.split(';')
+    params = {}
+    for param in parts[1:]:
+        if '=' in param:
+            key, param_value = param.split('=', 1)
+            params[key.upper()] = param_value.strip('"')
+    return parts[0].upper(), params, value
+
+def unescape(text):
+    result = []
+    characters = iter(text)
+    for character in characters:
+        if character == '\\':
+            escaped = characters.next()
+            result.append('\n' if escaped in 'nN' else escaped)
+        else:
+            result.append(character)
+    return u''.join(result)
+
+def events(lines):
+    """
+    Lazily yields a dictionary of properties, keyed by name, for each VEVENT in lines.
+    Values are (parameters, value) tuples, except for EXDATE which is a list of them as it
+    may occur more than once, and the event's raw lines are kept under 'RAW', used to detect changed events.
+    DTSTAMP lines are left out of 'RAW' as generators set them to the time the feed was generated.
+    Malformed lines are collected under 'ERRORS' rather than raised, so they only fail their own event.
+    """
+    event = None
+    for line in unfold(lines):
+        if not line:
+            continue
+        try:
+            name, params, value = parse_line(line)
+        except ValueError as e:
+            if event is not None:
+                event.setdefault('ERRORS', []).append(e)
+            continue
+        if name == 'BEGIN' and value.upper() == 'VEVENT':
+            event = {'RAW': []}
+        elif event is not None:
+            if name == 'END' and value.upper() == 'VEVENT':
+                yield event
+                event = None
+            else:
+                if name != 'DTSTAMP':
+                    event['RAW'].append(line)
+                if name == 'EXDATE':
+                    event.setdefault(name, []).append((params, value))
+                else:
+                    event.setdefault(name, (params, value))
+
+def parse_datetime(params, value):
+    """
+    Parses a DATE or DATE-TIME value to a naive local datetime.
+    UTC values are converted to local time, other time zones are treated as local time.
+    """
+    if params.get('VALUE') == 'DATE' or len(value) == 8:
+        return datetime.strptime(value[:8], '%Y%m%d')
+    if value.endswith('Z'):
+        utc = datetime.strptime(value[:15], '%Y%m%dT%H%M%S')
+        return datetime.fromtimestamp(calendar.timegm(utc.timetuple()))
+    return datetime.strptime(value[:15], '%Y%m%dT%H%M%S')
+
+def parse_duration(value):
+    """
+    Parses a DURATION value, i.e. P1DT2H30M or P2W, to a timedelta.
+    """
+    match = re.match(r'^([+-])?P(?:(\d+)W)?(?:(\d+)D)?(?:T(?:(\d+)H)?(?:(\d+)M)?(?:(\d+)S)?)?$', value)
+    if not match:
+        raise ValueError("Invalid duration '%s'." % value)
+    sign, weeks, days, hours, minutes, seconds = match.groups()
+    duration = timedelta(weeks=int(weeks or 0), days=int(days or 0), hours=int(hours or 0), minutes=int(minutes or 0), seconds=int(seconds or 0))
+    return -duration if sign == '-' else duration
+
+def parse_rrule(value):
+    return dict([part.split('=', 1) for part in value.upper().split(';') if '=' in part])
+
+def map_rrule(rule, start):
+    """
+    Maps a recurrence rule onto an entry repeat value, raising an error for rules that can't be represented.
+    """
+    freq = rule.get('FREQ')
+    days = set([day[-2:] for day in rule.get('BYDAY', '').split(',') if day])
+    unsupported = set(rule.keys()) - set(['FREQ', 'BYDAY', 'BYMONTHDAY', 'INTERVAL', 'UNTIL', 'COUNT', 'WKST'])
+    if unsupported:
+        raise ValueError("Unsupported recurrence rule parts %s." % ', '.join(sorted(unsupported)))
+    if freq == 'DAILY' and days and int(rule.get('INTERVAL', 1)) > 1:
+        raise ValueError("Unsupported recurrence rule, daily intervals can't be combined with BYDAY.")
+    if freq in ('DAILY', 'WEEKLY') and days == set(WEEKDAYS[:5]):
+        return 'weekdays'
+    if freq in ('DAILY', 'WEEKLY') and days == set(WEEKDAYS[5:]):
+        return 'weekends'
+    if freq == 'DAILY' and not days:
+        return 'daily'
+    if freq == 'WEEKLY' and (not days or days == set([WEEKDAYS[start.weekday()]])):
+        return 'weekly'
+    if freq == 'MONTHLY' and not days and rule.get('BYMONTHDAY', str(start.day)) == str(start.day):
+        return 'monthly_by_day_of_month'
+    if freq == 'MONTHLY' and not days and rule.get('BYMONTHDAY') == '-1' and start.day == calendar.monthrange(start.year, start.month)[1]:
+        return 'monthly_by_last_day_of_month'
+    if freq == 'MONTHLY' and 'BYMONTHDAY' not in rule and len(days) == 1 and days == set([WEEKDAYS[start.weekday()]]):
+        nth = rule['BYDAY'][:-2].lstrip('+')
+        if nth == '-1' and (start + timedelta(days=7)).month != start.month:
+            return 'monthly_by_last_day_of_week'
+        if nth == str((start.day - 1) // 7 + 1):
+            return 'monthly_by_day_of_week'
+    if freq == 'YEARLY' and not days and 'BYMONTHDAY' not in rule:
+        return 'yearly'
+    raise ValueError("Unsupported recurrence rule %s." % ';'.join(['%s=%s' % item for item in sorted(rule.items())]))
+
+def event_entry(event, entry=None):
+    """
+    Returns an unsaved entry, or entry updated, with start, end and repeat settings from event.
+    """
+    if entry is None:
+        entry = Entry()
+    start = parse_datetime(*event['DTSTART'])
+    if 'DTEND' in event:
+        end = parse_datetime(*event['DTEND'])
+    elif 'DURATION' in event:
+        end = start + parse_duration(event['DURATION'][1])
+    elif event['DTSTART'][0].get('VALUE') == 'DATE' or len(event['DTSTART'][1]) == 8:
+        end = start + timedelta(days=1)
+    else:
+        end = start
+    entry.start = start
+    entry.end = end
+    entry.repeat = 'does_not_repeat'
+    entry.repeat_every = None
+    entry.repeat_until = None
+
+    if 'RRULE' in event:
+        rule = parse_rrule(event['RRULE'][1])
+        entry.repeat = map_rrule(rule, start)
+        if int(rule.get('INTERVAL', 1)) > 1:
+            entry.repeat_every = int(rule['INTERVAL'])
+        if 'UNTIL' in rule:
+            entry.repeat_until = parse_datetime({}, rule['UNTIL']).date()
+        elif 'COUNT' in rule:
+            # expand the rule to find the date of the last of count occurrences
+            count = int(rule['COUNT'])
+            last_starts = list(itertools.islice(entry.occurrence_starts(), count - 1, count))
+            if not last_starts:
+                raise ValueError("Recurrence rule COUNT=%s can't be expanded." % count)
+            entry.repeat_until = last_starts[0].date()
+    return entry
+
+def default_content_factory(event, content=None):
+    """
+    Creates or updates content titled and described by event.
+    """
+    if content is None:
+        content = ModelBase()
+    content.title = unescape(event.get('SUMMARY', ({}, ''))[1])
+    content.description = unescape(event.get('DESCRIPTION', ({}, ''))[1])
+    content.save()
+    return content
+
+def import_events(lines, calendars=None, content_factory=default_content_factory, batch_size=500):
+    """
+    Imports VEVENTs from lines, i.e. an open .ics file, which is read incrementally.
+    Events are keyed on UID so re-imports update changed events and skip unchanged ones
+    without touching their entry items. New entries are created in batches of batch_size.
+    EXDATEs and events with a RECURRENCE-ID are applied as entry exceptions once all entries exist.
+    Returns a dictionary of created, updated, skipped and exception counts and a list of (uid, error) tuples.
+    """
+    result = {'created': 0, 'updated': 0, 'skipped': 0, 'exceptions': 0, 'errors': []}
+    batch = []
+    # (uid, date, cancelled, start, end) tuples
+    exceptions = []
+
+    def create_batch():
+        entries = []
+        for entry, event in batch:
+            try:
+                # validated before content is created so entries failing validation leave no content behind
+                entry.full_clean(exclude=['calendars', 'content'])
+                check_repeat(entry)
+                entry.content = content_factory(event)
+            except Exception as e:
+                result['errors'].append((entry.ical_uid, e))
+                continue
+            entries.append(entry)
+        del batch[:]
+        created, errors = Entry.objects.bulk_create_with_occurrences(entries, calendars=calendars)
+        result['created'] += len(created)
+        result['errors'] += [(entry.ical_uid, error) for entry, error in errors]
+
+    try:
+        for event in events(lines):
+            uid = event.get('UID', ({}, None))[1]
+            try:
+                if 'ERRORS' in event:
+                    raise event['ERRORS'][0]
+                if not uid:
+                    raise ValueError("Event has no UID.")
+                if 'RECURRENCE-ID' in event:
+                    override = event_entry(event)
+                    exceptions.append((uid, parse_datetime(*event['RECURRENCE-ID']).date(), False, override.start, override.end))
+                    continue
+                for params, value in event.get('EXDATE', []):
+                    exceptions += [(uid, parse_datetime(params, exdate).date(), True, None, None) for exdate in value.split(',')]
+                event_hash = hashlib.sha1(u'\n'.join(event['RAW']).encode('utf-8')).hexdigest()
+                existing = Entry.objects.filter(ical_uid=uid).select_related('content')[:1]
+                if existing:
+                    entry = existing[0]
+                    if entry.ical_hash == event_hash:
+                        result['skipped'] += 1
+                        continue
+                    entry = event_entry(event, entry)
+                    content_factory(event, entry.content)
+                    entry.ical_hash = event_hash
+                    entry.save()
+                    result['updated'] += 1
+                    continue
+
+                # content is created along with the batch, see create_batch
+                entry = event_entry(event)
+                entry.ical_uid = uid
+                entry.ical_hash = event_hash
+            except Exception as e:
+                result['errors'].append((uid, e))
+                continue
+            batch.append((entry, event))
+            if len(batch) >= batch_size:
+                create_batch()
+    finally:
+        # events read before any failure are still created
+        if batch:
+            create_batch()
+
+    entries = {}
+    for uid, day, cancelled, start, end in exceptions:
+        try:
+            if uid not in entries:
+                entries[uid] = Entry.objects.get(ical_uid=uid)
+            if cancelled:
+                entries[uid].cancel_occurrence(day)
+            else:
+                entries[uid].override_occurrence(day, start=start, end=end)
+        except Exception as e:
+            result['errors'].append((uid, e))
+            continue
+        result['exceptions'] += 1
+    return result
@@ -0,0 +1,199 @@
+"""
+In-process index of permitted entry items for hot range lookups, enabled with
+settings.CAL_OCCURRENCE_INDEX = True. Starts, ends and ids are kept in compact 64-bit
+arrays sorted by start, along with a running maximum of ends so overlap searches are
+answered with binary search instead of database queries. Arrays hold C longs where those
+are 64-bit and doubles otherwise, which represent whole seconds and ids exactly.
+
+The index loads in a single query and refreshes incrementally from the EntryItemChange
+log: changed entry items are masked in the arrays and their current state is kept in a
+small sorted overlay, which is merged into the arrays once it grows past a fraction of
+the index size. Times are kept at whole second resolution.
+"""
+from __future__ import with_statement
+
+from array import array
+from bisect import bisect_left, bisect_right, insort
+from collections import namedtuple
+from datetime import datetime, timedelta
+import threading
+import time
+
+from django.conf import settings
+from django.db.models import Max
+
+from cal.intervals import from_epoch, to_epoch
+
+Record = namedtuple('Record', ['id', 'start', 'end'])
+
+# Python 2 arrays have no long long typecode
+TYPECODE = 'l' if array('l').itemsize >= 8 else 'd'
+
+class State(object):
+    """
+    Immutable snapshot of an index, replaced as a whole on refresh so lookups need no locking.
+    """
+    def __init__(self, starts, ends, ids, masked, overlay):
+        self.starts = starts
+        self.ends = ends
+        self.ids = ids
+        # running maximum of ends, a prefix's items can only overlap times before it
+        self.reach = array(TYPECODE)
+        reach = None
+        for end in ends:
+            reach = end if reach is None or end > reach else reach
+            self.reach.append(reach)
+        # ids of array items that changed since the arrays were built
+        self.masked = masked
+        # sorted (start, end, id) tuples of changed items
+        self.overlay = overlay
+
+class OccurrenceIndex(object):
+    def __init__(self, site_id, staging=False):
+        self.site_id = site_id
+        self.staging = staging
+        self.lock = threading.Lock()
+        self.state = None
+        self.last_change_id = None
+        self.refreshed = None
+
+    def rows(self, entryitem_ids=None):
+        """
+        Returns (start, end, id) rows of entry items visible on the index's site, limited to entryitem_ids if provided.
+        """
+        from cal.models import EntryItemVisibility, chunked
+
+        visibility = EntryItemVisibility.objects.filter(site__id__exact=self.site_id)
+        if not self.staging:
+            visibility = visibility.filter(staging=False)
+        if entryitem_ids is None:
+            querysets = [visibility]
+        else:
+            querysets = [visibility.filter(entryitem__in=ids) for ids in chunked(entryitem_ids)]
+        rows = []
+        for queryset in querysets:
+            rows += [(to_epoch(start), to_epoch(end), entryitem_id) for start, end, entryitem_id in queryset.values_list('entryitem__start', 'entryitem__end', 'entryitem').distinct()]
+        return rows
+
+    def load(self):
+        """
+        Builds the index from scratch in a single query.
+        """
+        from cal.models import EntryItemChange
+
+        with self.lock:
+            last_change_id = EntryItemChange.objects.aggregate(last=Max('id'))['last'] or 0
+            self.state = self.build(sorted(self.rows()))
+            self.last_change_id = last_change_id
+            self.refreshed = time.time()
+
+    def build(self, rows):
+        starts = array(TYPECODE, [row[0] for row in rows])
+        ends = array(TYPECODE, [row[1] for row in rows])
+        ids = array(TYPECODE, [row[2] for row in rows])
+        return State(starts, ends, ids, frozenset(), [])
+
+    def refresh(self):
+        """
+        Applies entry item changes logged since the index was last loaded or refreshed.
+        Reloads the index if it's never been loaded or hasn't been refreshed within
+        settings.CAL_OCCURRENCE_INDEX_RETENTION seconds, as older changes might be pruned.
+        """
+        from cal.models import EntryItemChange
+
+        if self.state is None or time.time() - self.refreshed > getattr(settings, 'CAL_OCCURRENCE_INDEX_RETENTION', 86400):
+            return self.load()
+
+        with self.lock:
+            changes = list(EntryItemChange.objects.filter(id__gt=self.last_change_id).values_list('id', 'entryitem_id'))
+            if not changes:
+                self.refreshed = time.time()
+                return
+            changed_ids = set([entryitem_id for change_id, entryitem_id in changes])
+            state = self.state
+            masked = state.masked | changed_ids
+            # many changes, i.e. resaving a long series, are cheaper to reload than to patch in
+            threshold = max(1024, len(state.ids) // 20)
+            reload = len(state.overlay) + len(masked) > threshold
+            if not reload:
+                overlay = [row for row in state.overlay if row[2] not in changed_ids]
+                for row in self.rows(changed_ids):
+                    insort(overlay, row)
+
+                # merge the overlay into the arrays once it's no longer small
+                if len(overlay) + len(masked) > threshold:
+                    rows = [(start, end, entryitem_id) for start, end, entryitem_id in zip(state.starts, state.ends, state.ids) if entryitem_id not in masked]
+                    self.state = self.build(sorted(rows + overlay))
+                else:
+                    self.state = State(state.starts, state.ends, state.ids, masked, overlay)
+                # only recorded once the new state is in place, so failed refreshes are retried
+                self.last_change_id = max([change_id for change_id, entryitem_id in changes])
+                self.refreshed = time.time()
+        if reload:
+            self.load()
+
+    def search(self, start, end):
+        """
+        Returns (start, end, id) rows of entry items overlapping epoch seconds start and end, ordered by start.
+        """
+        state = self.state
+        # items starting at or after end can't overlap, nor can those in a prefix that ended by start
+        stop = bisect_left(state.starts, end)
+        first = bisect_right(state.reach, start, 0, stop)
+        rows = [(int(state.starts[i]), int(state.ends[i]), int(state.ids[i])) for i in range(first, stop) if state.ends[i] > start and state.ids[i] not in state.masked]
+        overlay = [row for row in state.overlay[:bisect_left(state.overlay, (end,))] if row[1] > start]
+        if overlay:
+            rows = sorted(rows + overlay)
+        return rows
+
+    def ids(self, start, end):
+        """
+        Returns ids of entry items overlapping start and end, ordered by start.
+        """
+        return [row[2] for row in self.search(to_epoch(start), to_epoch(end))]
+
+    def by_range(self, start, end):
+        """
+        Returns records of entry items overlapping start and end, ordered by start.
+        """
+        return [Record(row[2], from_epoch(row[0]), from_epoch(row[1])) for row in self.search(to_epoch(start), to_epoch(end))]
+
+    def by_date(self, date):
+        start = datetime(date.year, date.month, date.day)
+        return self.by_range(start, start + timedelta(days=1))
+
+    def now(self):
+        # a second long window overlaps items that started by now and end after it
+        now = to_epoch(datetime.now())
+        return [Record(row[2], from_epoch(row[0]), from_epoch(row[1])) for row in self.search(now, now + 1)]
+
+# indexes per (site id, staging), guarded by lock
+indexes = {}
+lock = threading.Lock()
+
+def get_index():
+    """
+    Returns the index of entry items permitted on the current site, loading or refreshing it
+    if it hasn't been refreshed in settings.CAL_OCCURRENCE_INDEX_REFRESH seconds (5 by default).
+    """
+    key = (settings.SITE_ID, getattr(settings, 'STAGING', False))
+    with lock:
+        index = indexes.get(key)
+        if index is None:
+            index = indexes[key] = OccurrenceIndex(*key)
+    if index.state is None or time.time() - index.refreshed > getattr(settings, 'CAL_OCCURRENCE_INDEX_REFRESH', 5):
+        index.refresh()
+    return index
+
+def prune_changes():
+    """
+    Deletes change log entries older than settings.CAL_OCCURRENCE_INDEX_RETENTION seconds (a day by default),
+    indexes that haven't been refreshed within that time are reloaded rather than refreshed.
+    Returns the number of change log entries deleted.
+    """
+    from cal.models import EntryItemChange
+
+    changes = EntryItemChange.objects.filter(changed__lt=datetime.now() - timedelta(seconds=getattr(settings, 'CAL_OCCURRENCE_INDEX_RETENTION', 86400)))
+    count = changes.count()
+    changes.delete()
+    return count
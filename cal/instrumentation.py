@@ -0,0 +1,132 @@
+"""
+Instrumentation of repeat handlers and entry item queries. Each measured operation sends the
+operation_measured signal with its query count, rows written or returned and elapsed time.
+Queries are only counted while Django records them, i.e. with settings.DEBUG = True or
+settings.CAL_COUNT_QUERIES = True, otherwise queries is None. Queries recorded only for counting
+are discarded again, as nothing resets them outside the request cycle, i.e. in worker threads.
+"""
+from __future__ import with_statement
+
+import logging
+import time
+
+from django.conf import settings
+from django.db import connection
+from django.db.models.query import QuerySet
+from django.dispatch import Signal
+
+operation_measured = Signal(providing_args=['operation', 'queries', 'rows', 'elapsed'])
+
+logger = logging.getLogger('cal')
+
+class measure(object):
+    """
+    Context manager measuring the operation it wraps. Set rows on it to report rows written or returned.
+    """
+    def __init__(self, operation):
+        self.operation = operation
+        self.rows = None
+        self.queries = None
+        self.elapsed = None
+        # cancelled measurements aren't reported
+        self.cancelled = False
+
+    def __enter__(self):
+        self.count_queries = getattr(settings, 'CAL_COUNT_QUERIES', settings.DEBUG)
+        if self.count_queries:
+            self.use_debug_cursor = connection.use_debug_cursor
+            connection.use_debug_cursor = True
+            self.start_count = len(connection.queries)
+        self.start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self.elapsed is None:
+            self.elapsed = time.time() - self.start
+        if self.count_queries:
+            self.queries = max(0, len(connection.queries) - self.start_count)
+            connection.use_debug_cursor = self.use_debug_cursor
+            # outermost measurements drop queries that wouldn't have been recorded otherwise
+            if not self.use_debug_cursor and not settings.DEBUG:
+                del connection.queries[self.start_count:]
+        if self.cancelled:
+            return False
+        operation_measured.send(sender=None, operation=self.operation, queries=self.queries, rows=self.rows, elapsed=self.elapsed)
+        return False
+
+def instrumented(operation):
+    """
+    Decorator measuring each call of the decorated function as operation.
+    Integer return values are reported as rows, i.e. rows written by repeat handlers.
+    """
+    def decorator(func):
+        def wrapper(*args, **kwargs):
+            with measure(operation) as measurement:
+                result = func(*args, **kwargs)
+                if isinstance(result, (int, long)) and not isinstance(result, bool):
+                    measurement.rows = result
+            return result
+        wrapper.__name__ = func.__name__
+        wrapper.__doc__ = func.__doc__
+        return wrapper
+    return decorator
+
+def labelled(operation):
+    """
+    Decorator for query methods. Returned querysets are labelled with operation so their evaluation
+    is measured as such, see EntryItemQuerySet.iterator. Returned iterators are measured as they are
+    consumed and anything else, i.e. lists of virtual occurrences, is measured as the call itself.
+    """
+    def decorator(func):
+        def wrapper(*args, **kwargs):
+            with measure(operation) as measurement:
+                result = func(*args, **kwargs)
+                if isinstance(result, QuerySet):
+                    measurement.cancelled = True
+                    result = result._clone(operation=operation)
+                elif hasattr(result, 'next') and not hasattr(result, '__len__'):
+                    measurement.cancelled = True
+                    result = measure_iterator(operation, result)
+                elif hasattr(result, '__len__'):
+                    measurement.rows = len(result)
+            return result
+        wrapper.__name__ = func.__name__
+        wrapper.__doc__ = func.__doc__
+        return wrapper
+    return decorator
+
+def measure_iterator(operation, items):
+    """
+    Lazily yields items, measuring time spent fetching them as operation and reporting the number of items as rows.
+    """
+    items = iter(items)
+    measurement = measure(operation)
+    measurement.__enter__()
+    elapsed = 0
+    rows = 0
+    try:
+        while True:
+            start = time.time()
+            try:
+                item = items.next()
+            except StopIteration:
+                break
+            finally:
+                elapsed += time.time() - start
+            rows += 1
+            yield item
+    finally:
+        # only report time spent fetching, not time spent by the consumer between items
+        measurement.rows = rows
+        measurement.elapsed = elapsed
+        measurement.__exit__(None, None, None)
+
+def log_slow_operations(sender, operation, queries, rows, elapsed, **kwargs):
+    """
+    Default collector logging operations slower than settings.CAL_SLOW_OPERATION_THRESHOLD seconds (1 by default).
+    """
+    threshold = getattr(settings, 'CAL_SLOW_OPERATION_THRESHOLD', 1.0)
+    if threshold is not None and elapsed >= threshold:
+        logger.warning("Slow calendar operation %s: %.3fs, %s queries, %s rows." % (operation, elapsed, queries, rows))
+
+operation_measured.connect(log_slow_operations)
@@ -0,0 +1,116 @@
+"""
+Interval arithmetic over entry item start and end times, i.e. for free/busy computation.
+Intervals are handled as int64 seconds since the epoch, using NumPy arrays when NumPy
+is installed and plain lists otherwise.
+"""
+from datetime import datetime, timedelta
+import heapq
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+EPOCH = datetime(1970, 1, 1)
+
+def to_epoch(value):
+    """
+    Returns whole seconds since the epoch for naive datetime value.
+    """
+    delta = value - EPOCH
+    return delta.days * 86400 + delta.seconds
+
+def from_epoch(seconds):
+    return EPOCH + timedelta(seconds=int(seconds))
+
+def merge(starts, ends):
+    """
+    Merges overlapping or touching intervals, given as sequences of epoch starts and ends.
+    Returns sorted starts and ends of the merged intervals.
+    """
+    if not len(starts):
+        return [], []
+    if numpy is not None:
+        starts = numpy.asarray(starts, dtype=numpy.int64)
+        ends = numpy.asarray(ends, dtype=numpy.int64)
+        order = numpy.argsort(starts, kind='mergesort')
+        starts = starts[order]
+        # furthest end reached by any interval so far
+        reach = numpy.maximum.accumulate(ends[order])
+        # an interval starts a new block if it starts after everything before it ended
+        first = numpy.concatenate(([True], starts[1:] > reach[:-1]))
+        last = numpy.concatenate((first[1:], [True]))
+        return starts[first].tolist(), reach[last].tolist()
+
+    merged_starts = []
+    merged_ends = []
+    for start, end in sorted(zip(starts, ends)):
+        if merged_ends and start <= merged_ends[-1]:
+            if end > merged_ends[-1]:
+                merged_ends[-1] = end
+        else:
+            merged_starts.append(start)
+            merged_ends.append(end)
+    return merged_starts, merged_ends
+
+def overlaps(intervals):
+    """
+    Yields (key, key) pairs for each pair of overlapping intervals, given as (start, end, key) tuples.
+    Intervals that merely touch don't overlap. Intervals are sorted and swept once, keeping a heap
+    of intervals still active, so this runs in O(n log n) plus the number of overlapping pairs.
+    """
+    active = []
+    for start, end, key in sorted(intervals, key=lambda interval: interval[:2]):
+        while active and active[0][0] <= start:
+            heapq.heappop(active)
+        for active_end, active_key in active:
+            yield active_key, key
+        heapq.heappush(active, (end, key))
+
+def gaps(starts, ends, start, end):
+    """
+    Returns starts and ends of the gaps between sorted, merged intervals within start and end.
+    """
+    gap_starts = []
+    gap_ends = []
+    position = start
+    for interval_start, interval_end in zip(starts, ends):
+        if interval_end <= position:
+            continue
+        if interval_start >= end:
+            break
+        if interval_start > position:
+            gap_starts.append(position)
+            gap_ends.append(interval_start)
+        position = interval_end
+    if position < end:
+        gap_starts.append(position)
+        gap_ends.append(end)
+    return gap_starts, gap_ends
+
+def freebusy(rows, start, end, keys=None):
+    """
+    Computes busy and free blocks per key within start and end from (start, end, key) rows.
+    Returns a dictionary mapping keys to {'busy': [(start, end), ...], 'free': [(start, end), ...]},
+    with busy blocks clamped to start and end. Keys without rows are included as entirely free.
+    """
+    window_start = to_epoch(start)
+    window_end = to_epoch(end)
+    intervals = dict([(key, ([], [])) for key in keys or []])
+    for row_start, row_end, key in rows:
+        key_starts, key_ends = intervals.setdefault(key, ([], []))
+        row_start = max(to_epoch(row_start), window_start)
+        row_end = min(to_epoch(row_end), window_end)
+        if row_start < row_end:
+            key_starts.append(row_start)
+            key_ends.append(row_end)
+
+    result = {}
+    for key, (key_starts, key_ends) in intervals.items():
+        busy_starts, busy_ends = merge(key_starts, key_ends)
+        free_starts, free_ends = gaps(busy_starts, busy_ends, window_start, window_end)
+        result[key] = {
+            'busy': [(from_epoch(s), from_epoch(e)) for s, e in zip(busy_starts, busy_ends)],
+            'free': [(from_epoch(s), from_epoch(e)) for s, e in zip(free_starts, free_ends)],
+        }
+    return result
@@ -0,0 +1,19 @@
+from django.core.management.base import NoArgsCommand
+
+from cal.models import Entry, EntryItem
+from panya.models import ModelBase
+
+class Command(NoArgsCommand):
+    help = "Populates the denormalized content type of entries and entry items stored before it was recorded."
+
+    def handle_noargs(self, **options):
+        # a single update per model and content type
+        rows = 0
+        for model in (Entry, EntryItem):
+            missing = model.objects.filter(content_type__isnull=True)
+            content_type_ids = ModelBase.objects.filter(id__in=missing.values('content')).values_list('content_type', flat=True).distinct()
+            for content_type_id in list(content_type_ids):
+                rows += missing.filter(content__content_type=content_type_id).update(content_type=content_type_id)
+
+        if int(options.get('verbosity', 1)) > 0:
+            self.stdout.write("Populated content type of %s entries and entry items.\n" % rows)
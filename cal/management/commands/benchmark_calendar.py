@@ -0,0 +1,92 @@
+from datetime import datetime, timedelta
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand
+from django.db import connection
+
+from cal import benchmarks
+from cal.managers import EntryItemQuerySet
+from cal.models import EntryItem
+
+class Command(NoArgsCommand):
+    help = "Benchmarks repeat handlers and entry item queries against synthetic data, reporting wall time and query counts."
+    option_list = NoArgsCommand.option_list + (
+        make_option('--suite', dest='suite', default='handlers,queries',
+            help='Comma separated suites to run: handlers, queries and/or explain.'),
+        make_option('--sizes', dest='sizes', default='10000,100000,1000000',
+            help='Comma separated synthetic entry item counts for the queries and explain suites.'),
+        make_option('--repeat', type='int', dest='repeat', default=5,
+            help='Number of times each benchmark is timed.'),
+        make_option('--baseline', dest='baseline', default=None,
+            help='Path of a baseline to compare results against.'),
+        make_option('--save-baseline', dest='save_baseline', default=None,
+            help='Path to store results at as a baseline for later runs.'),
+        make_option('--live-database', action='store_true', dest='live_database', default=False,
+            help='Run against the configured database instead of a throwaway test database. Synthetic data is '
+                'published on the current site while benchmarks run, and anything titled "cal benchmark" is deleted.'),
+        make_option('--noinput', action='store_false', dest='interactive', default=True,
+            help='Do not prompt before replacing an existing test database.'),
+    )
+
+    def handle_noargs(self, **options):
+        if options['live_database']:
+            return self.run(**options)
+
+        # synthetic data is published, so keep it out of the configured database
+        old_name = connection.settings_dict['NAME']
+        connection.creation.create_test_db(verbosity=0, autoclobber=not options['interactive'])
+        try:
+            self.run(**options)
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+
+    def run(self, **options):
+        suites = options['suite'].split(',')
+        sizes = [int(size) for size in options['sizes'].split(',')]
+        repeat = options['repeat']
+
+        results = []
+        if 'handlers' in suites:
+            results += benchmarks.benchmark_handlers(repeat=repeat)
+        if 'queries' in suites:
+            results += benchmarks.benchmark_queries(sizes=sizes, repeat=repeat)
+
+        if options['baseline']:
+            benchmarks.compare(results, benchmarks.load_baseline(options['baseline']))
+        for item in results:
+            line = "%-60s fastest %.4fs, mean %.4fs, %s queries" % (item['name'], item['fastest'], item['mean'], item['queries'])
+            if 'ratio' in item:
+                line += " (%.2fx baseline, %s queries)" % (item['ratio'], item['baseline_queries'])
+            self.stdout.write(line + "\n")
+        if options['save_baseline']:
+            benchmarks.save_baseline(results, options['save_baseline'])
+
+        if 'explain' in suites:
+            for size in sizes:
+                benchmarks.populate(size)
+                self.explain(size, repeat)
+                benchmarks.cleanup()
+
+    def explain(self, size, repeat):
+        """
+        Shows query plans and latency of range queries.
+        """
+        now = datetime.now()
+        start = now + timedelta(days=30)
+        end = start + timedelta(days=7)
+        queryset = EntryItemQuerySet(EntryItem)
+        
+        self.stdout.write("\nQuery plans against %s entry items.\n\n" % queryset.count())
+        queries = (
+            ('by_range (negated predicates)', queryset.exclude(start__gte=end).exclude(end__lte=start)),
+            ('by_range', queryset.by_range(start, end)),
+            ('now', queryset.now()),
+            ('upcoming[:100]', queryset.upcoming()[:100]),
+            ('permitted by_range', EntryItem.permitted.by_range(start, end)),
+        )
+        for name, query in queries:
+            fastest, mean = benchmarks.measure(lambda: list(query._clone()), repeat=repeat)
+            self.stdout.write("%s: fastest %.4fs, mean %.4fs\n" % (name, fastest, mean))
+            for line in benchmarks.explain(query):
+                self.stdout.write("    %s\n" % line)
+            self.stdout.write("\n")
@@ -0,0 +1,30 @@
+from datetime import date, timedelta
+
+from django.core.management.base import NoArgsCommand, CommandError
+from django.db.models import F, Q
+
+from cal.models import Entry, materialization_horizon
+
+class Command(NoArgsCommand):
+    help = "Extends stored entry items of repeating entries up to the materialization horizon (settings.CAL_MATERIALIZATION_HORIZON)."
+
+    def handle_noargs(self, **options):
+        horizon = materialization_horizon()
+        if horizon is None:
+            raise CommandError("settings.CAL_MATERIALIZATION_HORIZON is not set, all entry items are stored on save.")
+        limit = date.today() + timedelta(days=horizon)
+
+        # only entries that have not yet been materialized up to the horizon and repeat beyond what has been
+        entries = Entry.objects.exclude(repeat='does_not_repeat').filter(
+            Q(materialized_until__isnull=True) | \
+            (Q(materialized_until__lt=limit) & (Q(repeat_until__isnull=True) | Q(repeat_until__gt=F('materialized_until'))))
+        )
+
+        extended = 0
+        rows = 0
+        for entry in entries.iterator():
+            rows += entry.extend_entryitems()
+            extended += 1
+
+        if int(options.get('verbosity', 1)) > 0:
+            self.stdout.write("Extended %s entries, wrote %s entry items.\n" % (extended, rows))
@@ -0,0 +1,39 @@
+from datetime import datetime, timedelta
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand, CommandError
+
+from cal.managers import EntryItemQuerySet
+from cal.models import EntryItem
+
+class Command(NoArgsCommand):
+    help = "Lists overlapping entry items of different entries on the same calendar."
+    option_list = NoArgsCommand.option_list + (
+        make_option('--start', dest='start', default=None,
+            help='Start date of the window to check, as YYYY-MM-DD. Defaults to today.'),
+        make_option('--days', type='int', dest='days', default=30,
+            help='Number of days in the window to check.'),
+        make_option('--calendar', action='append', type='int', dest='calendars', default=[],
+            help='Id of a calendar to check, can be given more than once. Defaults to all calendars.'),
+    )
+
+    def handle_noargs(self, **options):
+        if options['start']:
+            try:
+                start = datetime.strptime(options['start'], '%Y-%m-%d')
+            except ValueError:
+                raise CommandError("Invalid start date '%s', use YYYY-MM-DD." % options['start'])
+        else:
+            start = datetime.combine(datetime.now().date(), datetime.min.time())
+        end = start + timedelta(days=options['days'])
+
+        conflicts = EntryItemQuerySet(EntryItem).conflicts(start, end, calendars=options['calendars'] or None)
+        items = EntryItem.objects.select_related('content').in_bulk(set([a for calendar_id, a, b in conflicts] + [b for calendar_id, a, b in conflicts]))
+        for calendar_id, a, b in conflicts:
+            self.stdout.write("Calendar %s: %s (%s - %s) overlaps %s (%s - %s)\n" % (
+                calendar_id,
+                items[a].content.title, items[a].start, items[a].end,
+                items[b].content.title, items[b].start, items[b].end,
+            ))
+        if int(options.get('verbosity', 1)) > 0:
+            self.stdout.write("Found %s conflicts between %s and %s.\n" % (len(conflicts), start, end))
@@ -0,0 +1,34 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from cal.ical import import_events
+from cal.models import Calendar
+
+class Command(BaseCommand):
+    args = '<path path ...>'
+    help = "Imports events from iCalendar (.ics) files, updating previously imported events that have changed."
+    option_list = BaseCommand.option_list + (
+        make_option('--calendar', action='append', type='int', dest='calendars', default=[],
+            help='Id of a calendar to add imported entries to, can be given more than once.'),
+        make_option('--batch-size', type='int', dest='batch_size', default=500,
+            help='Number of new entries created per batch.'),
+    )
+
+    def handle(self, *paths, **options):
+        if not paths:
+            raise CommandError("Provide the path of at least one .ics file.")
+        calendars = list(Calendar.objects.filter(id__in=options['calendars']))
+        if len(calendars) != len(set(options['calendars'])):
+            raise CommandError("Calendar(s) %s do not exist." % ', '.join([str(id) for id in set(options['calendars']) - set([calendar.id for calendar in calendars])]))
+
+        for path in paths:
+            ics = open(path, 'rU')
+            try:
+                result = import_events(ics, calendars=calendars, batch_size=options['batch_size'])
+            finally:
+                ics.close()
+            for uid, error in result['errors']:
+                self.stderr.write("%s: %s: %s\n" % (path, uid, error))
+            if int(options.get('verbosity', 1)) > 0:
+                self.stdout.write("%s: created %s, updated %s, skipped %s unchanged, applied %s exceptions, %s errors.\n" % (path, result['created'], result['updated'], result['skipped'], result['exceptions'], len(result['errors'])))
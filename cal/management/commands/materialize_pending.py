@@ -0,0 +1,35 @@
+from optparse import make_option
+import time
+
+from django.core.management.base import NoArgsCommand
+
+from cal import deferred
+from cal.models import Entry
+
+class Command(NoArgsCommand):
+    help = "Stores entry items for entries pending deferred materialization (settings.CAL_DEFERRED_MATERIALIZATION)."
+    option_list = NoArgsCommand.option_list + (
+        make_option('--limit', type='int', dest='limit', default=None,
+            help='Maximum number of entries to materialize per run.'),
+        make_option('--retry-failed', action='store_true', dest='retry_failed', default=False,
+            help='Queue entries that previously failed materializing again.'),
+        make_option('--reset-running', action='store_true', dest='reset_running', default=False,
+            help='Queue entries left running by an interrupted worker again. Only use while no other worker runs.'),
+        make_option('--poll', type='float', dest='poll', default=None,
+            help='Keep draining pending entries, checking for new ones every so many seconds.'),
+    )
+
+    def handle_noargs(self, **options):
+        if options['retry_failed']:
+            Entry.objects.filter(materialization_status='failed').update(materialization_status='pending')
+        if options['reset_running']:
+            Entry.objects.filter(materialization_status='running').update(materialization_status='pending')
+
+        while True:
+            materialized = deferred.run_pending(limit=options['limit'])
+            if int(options.get('verbosity', 1)) > 0 and (materialized or options['poll'] is None):
+                self.stdout.write("Materialized %s entries, %s failed.\n" % (materialized, Entry.objects.filter(materialization_status='failed').count()))
+            if options['poll'] is None:
+                break
+            if not materialized:
+                time.sleep(options['poll'])
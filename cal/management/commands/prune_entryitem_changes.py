@@ -0,0 +1,11 @@
+from django.core.management.base import NoArgsCommand
+
+from cal.index import prune_changes
+
+class Command(NoArgsCommand):
+    help = "Deletes entry item changes older than settings.CAL_OCCURRENCE_INDEX_RETENTION seconds from the log occurrence indexes refresh from."
+
+    def handle_noargs(self, **options):
+        pruned = prune_changes()
+        if int(options.get('verbosity', 1)) > 0:
+            self.stdout.write("Pruned %s entry item changes.\n" % pruned)
@@ -0,0 +1,13 @@
+from django.core.management.base import NoArgsCommand
+
+from cal.models import Entry, chunked, update_search_tokens
+
+class Command(NoArgsCommand):
+    help = "Rebuilds the search tokens the Entry admin searches, i.e. for entries stored before they were recorded."
+
+    def handle_noargs(self, **options):
+        entry_ids = list(Entry.objects.values_list('id', flat=True))
+        for ids in chunked(entry_ids):
+            update_search_tokens(ids)
+        if int(options.get('verbosity', 1)) > 0:
+            self.stdout.write("Rebuilt search tokens of %s entries.\n" % len(entry_ids))
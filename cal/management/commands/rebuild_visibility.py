@@ -0,0 +1,10 @@
+from django.core.management.base import NoArgsCommand
+
+from cal.models import EntryItem, update_visibility
+
+class Command(NoArgsCommand):
+    help = "Recomputes the denormalized per site visibility of all entry items, i.e. after installing or restoring data."
+
+    def handle_noargs(self, **options):
+        entryitem_ids = EntryItem.objects.values_list('id', flat=True).iterator()
+        update_visibility(entryitem_ids)
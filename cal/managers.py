@@ -1,18 +1,95 @@
-from datetime import datetime, timedelta
+from __future__ import with_statement
+
+from datetime import datetime, time, timedelta
+import heapq
+import itertools
+import math
 
 from django.conf import settings
 from django.contrib.contenttypes.models import ContentType
-from django.db import models
+from django.db import models, transaction
 from django.db.models.query import Q
 
-class EntryItemQuerySet(models.query.QuerySet):
+from cal import cache, intervals
+from cal.grid import PeriodGridMixin, next_month
+from cal.instrumentation import labelled, measure, measure_iterator
+
+def clamp_items(items, start, end):
+    """
+    Lazily yields items with their start and end contained within start and end,
+    keeping their stored values as unclamped_start and unclamped_end.
+    """
+    for item in items:
+        item.unclamped_start = item.start
+        item.unclamped_end = item.end
+        if item.start < start:
+            item.start = start
+        if item.end > end:
+            item.end = end
+        yield item
+
+class EntryItemQuerySet(PeriodGridMixin, models.query.QuerySet):
+    # start and end to which entry items are clamped when iterated, see clamp
+    window = None
+    # operation evaluation is measured as, see cal.instrumentation
+    operation = None
+
+    def _clone(self, klass=None, setup=False, **kwargs):
+        kwargs.setdefault('window', self.window)
+        kwargs.setdefault('operation', self.operation)
+        return super(EntryItemQuerySet, self)._clone(klass=klass, setup=setup, **kwargs)
+
+    def iterator(self):
+        items = super(EntryItemQuerySet, self).iterator()
+        if self.window is not None:
+            items = clamp_items(items, *self.window)
+        if self.operation is not None:
+            items = measure_iterator(self.operation, items)
+        return items
+
+    def count(self):
+        if self.operation is None:
+            return super(EntryItemQuerySet, self).count()
+        with measure('%s.count' % self.operation):
+            return super(EntryItemQuerySet, self).count()
+
+    def clamp(self, start, end):
+        """
+        Clamps entry items' start and end to start and end as they are iterated.
+        The result stays chainable, so later filtering, slicing or pagination keeps the clamping.
+        """
+        return self._clone(window=(start, end))
+
+    def listing(self):
+        """
+        Joins content and entry and prefetches calendars, for rendering lists of entry items.
+        """
+        return listing(self, 'entry')
+
+    @labelled('EntryItemQuerySet.by_window')
+    def by_window(self, start, end):
+        """
+        Filters for entry items overlapping start and end, with their start and end clamped to the window.
+        """
+        return self.by_range(start, end).clamp(start, end)
+
+    @labelled('EntryItemQuerySet.by_model')
     def by_model(self, model):
         """
         Should only return entry items for content of the provided model.
+        Filters on the denormalized content type, so no join is needed.
         """
         content_type = ContentType.objects.get_for_model(model)
-        return self.filter(content__content_type__exact=content_type)
+        return self.filter(content_type__exact=content_type)
+
+    @labelled('EntryItemQuerySet.by_models')
+    def by_models(self, *models):
+        """
+        Should only return entry items for content of any of the provided models.
+        """
+        return self.filter(content_type__in=[ContentType.objects.get_for_model(model) for model in models])
 
+    @labelled('EntryItemQuerySet.now')
     def now(self):
         """
         Filters for currently active entry items
@@ -20,6 +97,7 @@ class EntryItemQuerySet(models.query.QuerySet):
         now = datetime.now()
         return self.filter(start__lt=now, end__gt=now)
 
+    @labelled('EntryItemQuerySet.by_date')
     def by_date(self, date):
         start = datetime(date.year, date.month, date.day)
         end = start + timedelta(days=1)
@@ -30,84 +108,459 @@ class EntryItemQuerySet(models.query.QuerySet):
 
         return self.by_range(start, end)
     
+    @labelled('EntryItemQuerySet.by_range')
     def by_range(self, start, end):
-        return self.exclude(start__gte=end).exclude(end__lte=start)
+        """
+        Filters for entry items overlapping start and end.
+        """
+        return self.filter(start__lt=end, end__gt=start)
 
+    @labelled('EntryItemQuerySet.freebusy')
+    def freebusy(self, start, end, calendars=None):
+        """
+        Returns busy and free blocks within start and end per calendar id, merged across entry items,
+        as {calendar_id: {'busy': [(start, end), ...], 'free': [(start, end), ...]}}.
+        Only start, end and calendar id are fetched. Calendars without entry items in the window are
+        included as entirely free if provided through calendars.
+        """
+        # fetch through the calendar link table so each (entry item, calendar) pair is a single row
+        links = self.model.calendars.through.objects.filter(entryitem__in=self.by_range(start, end).values('pk'))
+        calendar_ids = None
+        if calendars is not None:
+            calendar_ids = [getattr(calendar, 'id', calendar) for calendar in calendars]
+            links = links.filter(calendar__in=calendar_ids)
+        rows = links.values_list('entryitem__start', 'entryitem__end', 'calendar').order_by()
+        return intervals.freebusy(rows.iterator(), start, end, keys=calendar_ids)
+
+    @labelled('EntryItemQuerySet.conflicts')
+    def conflicts(self, start, end, calendars=None):
+        """
+        Returns pairs of overlapping entry items of different entries on the same calendar within start and end,
+        as a list of (calendar_id, entryitem_id, entryitem_id) tuples. Each calendar's entry items are swept once
+        after sorting, rather than compared pairwise.
+        """
+        links = self.model.calendars.through.objects.filter(entryitem__in=self.by_range(start, end).values('pk'))
+        if calendars is not None:
+            links = links.filter(calendar__in=[getattr(calendar, 'id', calendar) for calendar in calendars])
+        calendar_items = {}
+        for entryitem_id, entry_id, item_start, item_end, calendar_id in links.values_list('entryitem', 'entryitem__entry', 'entryitem__start', 'entryitem__end', 'calendar').order_by().iterator():
+            calendar_items.setdefault(calendar_id, []).append((item_start, item_end, (entry_id, entryitem_id)))
+
+        result = []
+        for calendar_id in sorted(calendar_items):
+            for (entry_id, entryitem_id), (other_entry_id, other_entryitem_id) in intervals.overlaps(calendar_items[calendar_id]):
+                if entry_id != other_entry_id:
+                    result.append((calendar_id, min(entryitem_id, other_entryitem_id), max(entryitem_id, other_entryitem_id)))
+        return result
+
+    @labelled('EntryItemQuerySet.next7days')
     def next7days(self):
         start = datetime.now()
         end = start + timedelta(days=7)
-        return self.by_range(start, end)
+        return self.by_window(start, end)
 
+    @labelled('EntryItemQuerySet.thisweekend')
     def thisweekend(self):
         now = datetime.now()
         start = now + timedelta(4 - now.weekday())
         end = now + timedelta(6 - now.weekday())
-        result = self.by_range(start, end)
-
-        # set the entry start and end dates to be contained within the weekend
-        for item in result:
-            if item.start < start:
-                item.start = start
-            if item.end > end:
-                item.end = end 
-        return result
 
+        # entry start and end dates are contained within the weekend
+        return self.by_window(start, end)
+
+    @labelled('EntryItemQuerySet.thismonth')
     def thismonth(self):
         start = datetime.now()
-        end = datetime(start.year, (start.month+1), 1)
-        return self.by_range(start, end)
+        end = datetime.combine(next_month(start), time())
+        return self.by_window(start, end)
 
+    @labelled('EntryItemQuerySet.upcoming')
     def upcoming(self):
         now = datetime.now()
-        return self.exclude(end__lte=now)
+        return self.filter(end__gt=now)
+
+def virtual_mode():
+    """
+    Whether occurrences are expanded at query time instead of stored as entry items.
+    """
+    return getattr(settings, 'CAL_VIRTUAL_OCCURRENCES', False)
+
+def listing(queryset, *related):
+    """
+    Joins content and prefetches calendars of a queryset of entries or entry items,
+    so rendering any number of them, i.e. their titles and calendars, costs a constant number of queries.
+    Further relations to join can be provided as related, as select_related calls replace earlier ones.
+    """
+    return queryset.select_related('content', *related).prefetch_related('calendars')
+
+def permitted(queryset):
+    """
+    Filters a queryset of entries for those with published calendars and content on the current site.
+    Entry items are filtered on their denormalized visibility instead, see PermittedManager.
+    """
+    # exclude entries for unpublished calendars
+    queryset = queryset.exclude(calendars__state='unpublished')
+    
+    # exclude entries for unpublished content
+    queryset = queryset.exclude(content__state='unpublished')
+
+    # exclude objects in staging state if not in staging mode (settings.STAGING = False)
+    if not getattr(settings, 'STAGING', False):
+        # exclude entries for staging calendars
+        queryset = queryset.exclude(calendars__state='staging')
+    
+        # exclude entries for staging content
+        queryset = queryset.exclude(content__state='staging')
+
+    # filter calendar for current site 
+    queryset = queryset.filter(calendars__sites__id__exact=settings.SITE_ID)
+    
+    # filter content for current site 
+    queryset = queryset.filter(content__sites__id__exact=settings.SITE_ID)
+    
+    return queryset
+
+class Occurrence(object):
+    """
+    Lightweight stand-in for an EntryItem, expanded from its entry's repeat rule at query time.
+    Occurrences aren't stored, so their id and pk are None.
+    """
+    id = None
+    pk = None
+
+    def __init__(self, entry, start, end, exception=None, occurrence_date=None):
+        self.entry = entry
+        self.entry_id = entry.id
+        self.exception = exception
+        self.content_id = (exception.content_id or entry.content_id) if exception else entry.content_id
+        self.occurrence_date = occurrence_date or start.date()
+        self.start = start
+        self.end = end
+
+    @property
+    def content_type_id(self):
+        if self.exception and self.exception.content_id:
+            return self.exception.content.content_type_id
+        return self.entry.content_type_id
+
+    @property
+    def content_type(self):
+        return ContentType.objects.get_for_id(self.content_type_id)
+
+    @property
+    def content(self):
+        if self.exception and self.exception.content_id:
+            return self.exception.content
+        return self.entry.content
+
+    @property
+    def calendars(self):
+        if self.exception and self.exception.calendars.exists():
+            return self.exception.calendars
+        return self.entry.calendars
+    
+    @property
+    def duration(self):
+        return self.end - self.start
+
+    def __unicode__(self):
+        return "Entry Item for %s" % self.content.title
+
+class OccurrenceSet(PeriodGridMixin):
+    """
+    Expands the repeat rules of a queryset of entries into occurrences for the requested window only,
+    without requiring entry items to be stored.
+    """
+    def __init__(self, queryset):
+        self.queryset = queryset
+
+    def expand(self, start, end=None):
+        """
+        Yields occurrences overlapping start and end, ordered by start. 
+        Without an end occurrences are expanded lazily until each entry's repeat until value.
+        Cancelled occurrences are skipped and overridden ones take their exception's values,
+        though they keep the position of their original start in the ordering.
+        """
+        from cal.models import EntryException
+
+        # occurrences starting up to max duration before the window might still overlap it 
+        max_duration = getattr(settings, 'CAL_MAX_OCCURRENCE_DURATION', timedelta(days=7))
+        
+        entries = self.queryset.filter(
+            Q(repeat='does_not_repeat', end__gt=start) | \
+            (~Q(repeat='does_not_repeat') & (Q(repeat_until__isnull=True) | Q(repeat_until__gte=(start - max_duration).date())))
+        )
+        if end is not None:
+            entries = entries.filter(start__lt=end)
+        
+        entries = list(entries.select_related('content').distinct())
+        exceptions = EntryException.objects.filter(entry__in=[entry.id for entry in entries], date__gte=(start - max_duration).date())
+        if end is not None:
+            exceptions = exceptions.filter(date__lte=end.date())
+        exceptions = dict([((exception.entry_id, exception.date), exception) for exception in exceptions])
+
+        def entry_occurrences(entry):
+            duration = entry.duration
+            for occurrence_start in entry.occurrence_starts(since=(start - duration).date()):
+                if end is not None and occurrence_start >= end:
+                    break
+                exception = exceptions.get((entry.id, occurrence_start.date()))
+                if exception is None:
+                    occurrence = Occurrence(entry, occurrence_start, occurrence_start + duration)
+                elif exception.cancelled:
+                    continue
+                else:
+                    overridden_start = exception.start or occurrence_start
+                    occurrence = Occurrence(entry, overridden_start, exception.end or overridden_start + duration, exception, occurrence_start.date())
+                if occurrence.end > start and (end is None or occurrence.start < end):
+                    yield (occurrence_start, entry.id, occurrence)
+
+        occurrences = [entry_occurrences(entry) for entry in entries]
+        for occurrence_start, entry_id, occurrence in heapq.merge(*occurrences):
+            yield occurrence
+
+    def listing(self):
+        return OccurrenceSet(listing(self.queryset))
 
-class PermittedManager(models.Manager):
+    def freebusy(self, start, end, calendars=None):
+        links = self.queryset.model.calendars.through.objects.filter(entry__in=self.queryset.values('pk'))
+        calendar_ids = None
+        if calendars is not None:
+            calendar_ids = [getattr(calendar, 'id', calendar) for calendar in calendars]
+            links = links.filter(calendar__in=calendar_ids)
+        entry_calendars = {}
+        for entry_id, calendar_id in links.values_list('entry', 'calendar'):
+            entry_calendars.setdefault(entry_id, []).append(calendar_id)
+        rows = ((occurrence.start, occurrence.end, calendar_id) for occurrence in self.expand(start, end) for calendar_id in entry_calendars.get(occurrence.entry_id, []))
+        return intervals.freebusy(rows, start, end, keys=calendar_ids)
+
+    def by_model(self, model):
+        content_type = ContentType.objects.get_for_model(model)
+        return OccurrenceSet(self.queryset.filter(content_type__exact=content_type))
+
+    def by_models(self, *models):
+        return OccurrenceSet(self.queryset.filter(content_type__in=[ContentType.objects.get_for_model(model) for model in models]))
+
+    def now(self):
+        now = datetime.now()
+        return list(self.expand(now, now + timedelta(microseconds=1)))
+
+    def by_date(self, date):
+        start = datetime(date.year, date.month, date.day)
+        end = start + timedelta(days=1)
+        return self.by_range(start, end)
+
+    def by_range(self, start, end):
+        return list(self.expand(start, end))
+
+    def by_window(self, start, end):
+        return list(clamp_items(self.expand(start, end), start, end))
+
+    def next7days(self):
+        start = datetime.now()
+        end = start + timedelta(days=7)
+        return self.by_window(start, end)
+
+    def thisweekend(self):
+        now = datetime.now()
+        start = now + timedelta(4 - now.weekday())
+        end = now + timedelta(6 - now.weekday())
+        return self.by_window(start, end)
+
+    def thismonth(self):
+        start = datetime.now()
+        end = datetime.combine(next_month(start), time())
+        return self.by_window(start, end)
+
+    def upcoming(self):
+        return self.expand(datetime.now())
+
+class PermittedManager(PeriodGridMixin, models.Manager):
     def get_query_set(self):
         # get base queryset
         queryset = EntryItemQuerySet(self.model)
-        
-        # exclude entries for unpublished calendars
-        queryset = queryset.exclude(calendars__state='unpublished')
-        
-        # exclude entries for unpublished content
-        queryset = queryset.exclude(content__state='unpublished')
 
-        # exclude objects in staging state if not in staging mode (settings.STAGING = False)
+        # filter for entry items visible on the current site using their denormalized visibility,
+        # excluding objects in staging state if not in staging mode (settings.STAGING = False)
+        visibility = {'visibility_set__site__id__exact': settings.SITE_ID}
         if not getattr(settings, 'STAGING', False):
-            # exclude entries for staging calendars
-            queryset = queryset.exclude(calendars__state='staging')
-        
-            # exclude entries for staging content
-            queryset = queryset.exclude(content__state='staging')
+            visibility['visibility_set__staging'] = False
+        return queryset.filter(**visibility)
 
-        # filter calendar for current site 
-        queryset = queryset.filter(calendars__sites__id__exact=settings.SITE_ID)
-        
-        # filter content for current site 
-        queryset = queryset.filter(content__sites__id__exact=settings.SITE_ID)
-        
-        return queryset
+    def occurrences(self):
+        """
+        Returns permitted occurrences expanded from entries' repeat rules at query time.
+        Used in place of stored entry items when settings.CAL_VIRTUAL_OCCURRENCES = True.
+        """
+        entry_model = self.model._meta.get_field('entry').rel.to
+        return OccurrenceSet(permitted(entry_model.objects.all()))
+
+    def listing(self):
+        if virtual_mode():
+            return self.occurrences().listing()
+        return self.get_query_set().listing()
 
+    @labelled('PermittedManager.by_model')
     def by_model(self, model):
+        if virtual_mode():
+            return self.occurrences().by_model(model)
         return self.get_query_set().by_model(model)
 
+    @labelled('PermittedManager.by_models')
+    def by_models(self, *models):
+        if virtual_mode():
+            return self.occurrences().by_models(*models)
+        return self.get_query_set().by_models(*models)
+
+    @labelled('PermittedManager.now')
     def now(self):
+        if virtual_mode():
+            return self.occurrences().now()
         return self.get_query_set().now()
 
+    def index(self):
+        """
+        Returns the in-process index of entry items permitted on the current site, for range lookups
+        without querying the database. Requires settings.CAL_OCCURRENCE_INDEX = True, see cal.index.
+        """
+        if not getattr(settings, 'CAL_OCCURRENCE_INDEX', False):
+            raise Exception("The occurrence index requires settings.CAL_OCCURRENCE_INDEX = True.")
+        from cal.index import get_index
+        return get_index()
+
+    @labelled('PermittedManager.freebusy')
+    def freebusy(self, start, end, calendars=None):
+        if virtual_mode():
+            return self.occurrences().freebusy(start, end, calendars)
+        return self.get_query_set().freebusy(start, end, calendars)
+
+    @labelled('PermittedManager.cached_now')
+    def cached_now(self):
+        """
+        Returns a list of currently active entry items, cached until the next time
+        one of the current items ends or an upcoming item starts.
+        """
+        backend = cache.get_backend()
+        key = cache.make_key('now', settings.SITE_ID, getattr(settings, 'STAGING', False))
+        now = datetime.now()
+        result = backend.get(key)
+        if result is not None and (result['expires'] is None or result['expires'] > now):
+            return result['items']
+
+        if virtual_mode():
+            items = self.occurrences().now()
+            next_starts = list(itertools.islice((occurrence.start for occurrence in self.occurrences().expand(now) if occurrence.start > now), 1))
+        else:
+            items = list(self.now().select_related('content'))
+            next_starts = list(self.get_query_set().filter(start__gt=now).order_by('start').values_list('start', flat=True)[:1])
+        boundaries = [item.end for item in items] + next_starts
+        expires = min(boundaries) if boundaries else None
+        
+        # without an upcoming boundary the result is cached for the backend's default timeout
+        timeout = None
+        if expires is not None:
+            delta = expires - now
+            timeout = max(1, int(math.ceil(delta.days * 86400 + delta.seconds + delta.microseconds / 1000000.0)))
+        backend.set(key, {'expires': expires, 'items': items}, timeout)
+        return items
+
+    @labelled('PermittedManager.by_date')
     def by_date(self, date):
+        if virtual_mode():
+            return self.occurrences().by_date(date)
         return self.get_query_set().by_date(date)
     
+    @labelled('PermittedManager.by_range')
     def by_range(self, start, end):
+        if virtual_mode():
+            return self.occurrences().by_range(start, end)
         return self.get_query_set().by_range(start, end)
+
+    @labelled('PermittedManager.by_window')
+    def by_window(self, start, end):
+        if virtual_mode():
+            return self.occurrences().by_window(start, end)
+        return self.get_query_set().by_window(start, end)
         
+    @labelled('PermittedManager.next7days')
     def next7days(self):
+        if virtual_mode():
+            return self.occurrences().next7days()
         return self.get_query_set().next7days()
         
+    @labelled('PermittedManager.thisweekend')
     def thisweekend(self):
+        if virtual_mode():
+            return self.occurrences().thisweekend()
         return self.get_query_set().thisweekend()
         
+    @labelled('PermittedManager.thismonth')
     def thismonth(self):
+        if virtual_mode():
+            return self.occurrences().thismonth()
         return self.get_query_set().thismonth()
         
+    @labelled('PermittedManager.upcoming')
     def upcoming(self):
+        if virtual_mode():
+            return self.occurrences().upcoming()
         return self.get_query_set().upcoming()
+
+    @labelled('PermittedManager.period_grid')
+    def period_grid(self, date, days):
+        """
+        Returns a DayBucket for each of days starting at date, cached per site and period
+        until entries, calendars or content change. Items are cached along with their content
+        and calendars, see listing, so rendering a cached grid needs no further queries.
+        """
+        backend = cache.get_backend()
+        key = cache.make_key('grid', settings.SITE_ID, getattr(settings, 'STAGING', False), virtual_mode(), date.isoformat(), days)
+        grid = backend.get(key)
+        if grid is None:
+            if virtual_mode():
+                grid = self.occurrences().listing().period_grid(date, days)
+            else:
+                grid = self.get_query_set().listing().period_grid(date, days)
+            backend.set(key, grid, getattr(settings, 'CAL_CACHE_TIMEOUT', None))
+        return grid
+
+class EntryManager(models.Manager):
+    def listing(self):
+        return listing(self.get_query_set())
+
+    def bulk_create_with_occurrences(self, entries, calendars=None):
+        """
+        Creates entries, linked to calendars, along with their entry items and calendar links in a
+        single transaction. Entry items for all entries are written in batched statements.
+        Entries failing validation or materialization are skipped without aborting the batch.
+        Returns a tuple of the list of created entries and a list of (entry, error) tuples.
+        """
+        from cal.models import bulk_materialize, check_repeat, planned_starts, update_search_tokens
+
+        calendar_ids = [getattr(calendar, 'id', calendar) for calendar in calendars or []]
+        created = []
+        errors = []
+        planned = []
+        with transaction.commit_on_success():
+            for entry in entries:
+                savepoint = transaction.savepoint()
+                try:
+                    entry.full_clean(exclude=['calendars'])
+                    check_repeat(entry)
+                    starts = [] if virtual_mode() else planned_starts(entry)
+                    # save the entry row only, its entry items are created in bulk below
+                    entry.set_content_type()
+                    models.Model.save(entry)
+                except Exception as e:
+                    transaction.savepoint_rollback(savepoint)
+                    errors.append((entry, e))
+                    continue
+                transaction.savepoint_commit(savepoint)
+                created.append(entry)
+                planned.append((entry, starts))
+
+            through = self.model.calendars.through
+            through.objects.bulk_create([through(entry_id=entry.id, calendar_id=calendar_id) for entry in created for calendar_id in calendar_ids])
+            bulk_materialize(planned, calendar_ids)
+            update_search_tokens([entry.id for entry in created])
+        return created, errors
@@ -1,151 +1,530 @@
-from datetime import datetime, timedelta
+from datetime import date, datetime, timedelta
+import itertools
+import re
 
+from django.conf import settings
+from django.contrib.contenttypes.models import ContentType
+from django.core.validators import MinValueValidator
 from django.db import models
+from django.db.models import F, signals
 
-from cal.managers import PermittedManager
+from cal import cache, deferred, intervals, recurrence
+from cal.instrumentation import instrumented
+from cal.managers import EntryManager, PermittedManager, virtual_mode
 from panya.models import ModelBase
 
+@instrumented('save_handler_does_not_repeat')
 def save_handler_does_not_repeat(entry):
     # raise an error if wrong handler is triggered
     if entry.repeat != 'does_not_repeat':
         raise Exception("In handler 'save_handler_does_not_repeat' for entry with repeat set as '%s'" % entry.repeat)
 
-    # delete all entry items related to this entry
-    # XXX: yes this is not super efficient, but results in the cleanest code.
-    entry.delete_entryitem_set()
-
     # create a single entryitem linked to entry with provided entry's fields
-    entry_item = EntryItem(start=entry.start, end=entry.end, entry=entry, content=entry.content)
-    entry_item.save()
+    return sync_entryitems(entry, single_repeater(entry))
+
+def chunked(ids, size=500):
+    """
+    Splits ids into lists small enough to be used in a single IN clause.
+    """
+    ids = list(ids)
+    for i in range(0, len(ids), size):
+        yield ids[i:i + size]
+
+def sync_entryitems(entry, starts, since=None, until=None):
+    """
+    Brings entry's entry items in line with the provided start datetimes and entry's exceptions.
+    Existing items are matched to occurrences on their occurrence date, so only
+    missing occurrences are inserted, obsolete ones deleted and changed start and
+    end times updated, keeping the work proportional to the change.
+    Cancelled occurrences aren't stored and overridden ones take their exception's values.
+    Providing since and/or until dates limits the sync to occurrences on or between those dates.
+    Returns the number of entry item rows written.
+    """
+    if since is None and until is None:
+        entryitem_set = entry.entryitem_set.all()
+    else:
+        # items stored before occurrence dates were recorded are windowed on their start
+        window = models.Q(occurrence_date__isnull=False)
+        legacy_window = models.Q(occurrence_date__isnull=True)
+        if since is not None:
+            window &= models.Q(occurrence_date__gte=since)
+            legacy_window &= models.Q(start__gte=datetime(since.year, since.month, since.day))
+        if until is not None:
+            window &= models.Q(occurrence_date__lte=until)
+            legacy_window &= models.Q(start__lt=datetime(until.year, until.month, until.day) + timedelta(days=1))
+        entryitem_set = entry.entryitem_set.filter(window | legacy_window)
+
+    exception_set = entry.exception_set.all()
+    if since is not None:
+        exception_set = exception_set.filter(date__gte=since)
+    if until is not None:
+        exception_set = exception_set.filter(date__lte=until)
+    exceptions = dict([(exception.date, exception) for exception in exception_set])
+    exception_calendar_ids = {}
+    if exceptions:
+        exception_through = EntryException.calendars.through
+        for exception_id, calendar_id in exception_through.objects.filter(entryexception__in=[exception.id for exception in exceptions.values()]).values_list('entryexception', 'calendar'):
+            exception_calendar_ids.setdefault(exception_id, set()).add(calendar_id)
+
+    # target (start, end, content id, calendar ids or None for entry's calendars) per occurrence date
+    duration = entry.duration
+    targets = {}
+    for start in starts:
+        day = start.date()
+        exception = exceptions.get(day)
+        if exception is None:
+            targets[day] = (start, start + duration, entry.content_id, None)
+        elif not exception.cancelled:
+            targets[day] = (
+                exception.start or start,
+                exception.end or (exception.start or start) + duration,
+                exception.content_id or entry.content_id,
+                exception_calendar_ids.get(exception.id),
+            )
+
+    # content types are denormalized onto entry items along with their content
+    if entry.content_type_id is None:
+        entry.set_content_type()
+    content_types = {entry.content_id: entry.content_type_id}
+    override_content_ids = set([target[2] for target in targets.values()]) - set(content_types.keys())
+    if override_content_ids:
+        content_types.update(ModelBase.objects.filter(id__in=override_content_ids).values_list('id', 'content_type'))
+
+    # match existing items to target occurrences, anything left over is obsolete
+    existing = {}
+    obsolete_ids = []
+    stale_contents = {}
+    undated = {}
+    for entryitem_id, occurrence_date, start, end, content_id, content_type_id in entryitem_set.values_list('id', 'occurrence_date', 'start', 'end', 'content', 'content_type'):
+        day = occurrence_date or start.date()
+        if day in targets and day not in existing:
+            existing[day] = (entryitem_id, start, end)
+            if content_id != targets[day][2] or content_type_id != content_types[targets[day][2]]:
+                stale_contents.setdefault(targets[day][2], []).append(entryitem_id)
+            if occurrence_date is None:
+                undated[entryitem_id] = day
+        else:
+            obsolete_ids.append(entryitem_id)
+
+    # group changed items by how far they moved so each group is a single update
+    shifts = {}
+    for day, (entryitem_id, start, end) in existing.items():
+        target_start, target_end = targets[day][:2]
+        if start != target_start or end != target_end:
+            shifts.setdefault((target_start - start, target_end - end), []).append(entryitem_id)
+
+    for ids in chunked(obsolete_ids):
+        EntryItem.objects.filter(id__in=ids).delete()
+    for (start_shift, end_shift), shifted_ids in shifts.items():
+        for ids in chunked(shifted_ids):
+            EntryItem.objects.filter(id__in=ids).update(start=F('start') + start_shift, end=F('end') + end_shift)
+            log_changes(ids)
+    for content_id, stale_ids in stale_contents.items():
+        for ids in chunked(stale_ids):
+            EntryItem.objects.filter(id__in=ids).update(content=content_id, content_type=content_types[content_id])
+    # items stored before occurrence dates were recorded get theirs once
+    for entryitem_id, day in undated.items():
+        EntryItem.objects.filter(id=entryitem_id).update(occurrence_date=day)
+
+    entry_items = [EntryItem(start=start, end=end, occurrence_date=day, entry=entry, content_id=content_id, content_type_id=content_types[content_id]) for day, (start, end, content_id, calendar_ids) in targets.items() if day not in existing]
+    if entry_items:
+        EntryItem.objects.bulk_create(entry_items)
+
+    # link entry items to entry's or their exception's calendars, only adding and removing changed links
+    through = EntryItem.calendars.through
+    entry_calendar_ids = set(entry.calendars.values_list('id', flat=True))
+    if entry_items:
+        # bulk inserts don't provide primary keys, so collect them in a single query.
+        entryitem_days = dict([(entryitem_id, occurrence_date or start.date()) for entryitem_id, occurrence_date, start in entryitem_set.values_list('id', 'occurrence_date', 'start')])
+    else:
+        entryitem_days = dict([(entryitem_id, day) for day, (entryitem_id, start, end) in existing.items()])
+    calendar_ids = {}
+    for entryitem_id, day in entryitem_days.items():
+        target_calendar_ids = targets[day][3] if day in targets else None
+        calendar_ids[entryitem_id] = entry_calendar_ids if target_calendar_ids is None else target_calendar_ids
+
+    links = set()
+    unlinked = {}
+    for link_id, entryitem_id, calendar_id in through.objects.filter(entryitem__in=entryitem_set).values_list('id', 'entryitem', 'calendar'):
+        if calendar_id in calendar_ids.get(entryitem_id, ()):
+            links.add((entryitem_id, calendar_id))
+        else:
+            unlinked[link_id] = entryitem_id
+    for ids in chunked(unlinked.keys()):
+        through.objects.filter(id__in=ids).delete()
+
+    new_links = [through(entryitem_id=entryitem_id, calendar_id=calendar_id) for entryitem_id, item_calendar_ids in calendar_ids.items() for calendar_id in item_calendar_ids if (entryitem_id, calendar_id) not in links]
+    through.objects.bulk_create(new_links)
+
+    # links and content changed without sending signals, so update visibility of affected items
+    affected_ids = set()
+    for stale_ids in stale_contents.values():
+        affected_ids.update(stale_ids)
+    affected_ids.update(unlinked.values())
+    affected_ids.update([link.entryitem_id for link in new_links])
+    update_visibility(affected_ids)
+
+    rows = len(obsolete_ids) + sum([len(ids) for ids in shifts.values()]) + sum([len(ids) for ids in stale_contents.values()]) + len(undated) + len(entry_items)
+    if rows:
+        cache.invalidate()
+    return rows
+
+def materialization_horizon():
+    """
+    Returns the number of days ahead for which repeating entries' entry items are stored,
+    or None if all occurrences are stored up front.
+    """
+    return getattr(settings, 'CAL_MATERIALIZATION_HORIZON', None)
+
+def materialization_limit(entry):
+    """
+    Returns the last date for which entry items should currently be stored for repeating entry.
+    """
+    horizon = materialization_horizon()
+    if horizon is None:
+        return entry.repeat_until
+    limit = date.today() + timedelta(days=horizon)
+    if entry.repeat_until is not None and entry.repeat_until < limit:
+        return entry.repeat_until
+    return limit
+
+def materialize(entry, starts, since=None):
+    """
+    Syncs entry's entry items with the provided start datetimes up to entry's materialization limit,
+    recording the limit on the entry so entry items can later be extended from there.
+    """
+    until = materialization_limit(entry)
+    starts = itertools.takewhile(lambda start: start.date() <= until, starts)
+    rows = sync_entryitems(entry, starts, since=since)
+    entry.materialized_until = until
+    Entry.objects.filter(id=entry.id).update(materialized_until=until)
+    return rows
+
+class ConflictError(Exception):
+    """
+    Raised when saving an entry whose occurrences would overlap other entries' entry items on the same calendar.
+    """
+    def __init__(self, conflicts):
+        self.conflicts = conflicts
+        super(ConflictError, self).__init__("Entry overlaps %s entry item(s) on its calendars." % len(conflicts))
+
+def check_repeat(entry):
+    """
+    Raises an error if entry's repeat settings can't be materialized, as repeat handlers would.
+    """
+    if entry.repeat not in dict(Entry._meta.get_field('repeat').choices):
+        raise Exception("Entry has unknown repeat value '%s'." % entry.repeat)
+    if entry.repeat != 'does_not_repeat' and not entry.repeat_until and materialization_horizon() is None:
+        raise Exception("Entry should provide repeat_until value for '%s' repeat." % entry.repeat)
+
+def planned_starts(entry):
+    """
+    Returns the start datetimes of entry's occurrences up to its materialization limit.
+    """
+    if entry.repeat == 'does_not_repeat':
+        return [entry.start]
+    until = materialization_limit(entry)
+    return list(itertools.takewhile(lambda start: start.date() <= until, entry.occurrence_starts()))
 
-    for calendar in entry.calendars.all():
-        entry_item.calendars.add(calendar)
+def bulk_materialize(planned, calendar_ids):
+    """
+    Creates entry items for newly created entries in batched statements.
+    planned is a list of (entry, starts) tuples, each entry item is linked to calendar_ids.
+    Returns the number of entry item rows written.
+    """
+    entry_items = []
+    for entry, starts in planned:
+        duration = entry.duration
+        entry_items += [EntryItem(start=start, end=start + duration, occurrence_date=start.date(), entry=entry, content_id=entry.content_id, content_type_id=entry.content_type_id) for start in starts]
+    EntryItem.objects.bulk_create(entry_items)
 
-def day_repeater(entry, allowed_days=[0,1,2,3,4,5,6]):
-    day = entry.start.date()
-    while day <= entry.repeat_until:
-        if day.weekday() in allowed_days:
-            start = entry.start
-            start = start.replace(year=day.year, month=day.month, day=day.day)
-            end = start + entry.duration
-            entry_item = EntryItem(start=start, end=end, entry=entry, content=entry.content)
-            entry_item.save()
+    # bulk inserts don't provide primary keys, so collect them per batch of entries.
+    entryitem_ids = []
+    for ids in chunked([entry.id for entry, starts in planned]):
+        entryitem_ids += EntryItem.objects.filter(entry__in=ids).values_list('id', flat=True)
+    through = EntryItem.calendars.through
+    through.objects.bulk_create([through(entryitem_id=entryitem_id, calendar_id=calendar_id) for entryitem_id in entryitem_ids for calendar_id in calendar_ids])
+    update_visibility(entryitem_ids)
 
-            for calendar in entry.calendars.all():
-                entry_item.calendars.add(calendar)
+    # record materialization limits, grouped so each distinct limit is a single update
+    limits = {}
+    for entry, starts in planned:
+        if entry.repeat != 'does_not_repeat':
+            entry.materialized_until = materialization_limit(entry)
+            limits.setdefault(entry.materialized_until, []).append(entry.id)
+    for until, entry_ids in limits.items():
+        for ids in chunked(entry_ids):
+            Entry.objects.filter(id__in=ids).update(materialized_until=until)
 
-        day = day + timedelta(days=1)
+    if entry_items:
+        cache.invalidate()
+    return len(entry_items)
 
+def log_changes(entryitem_ids):
+    """
+    Records entry items as changed for in-process occurrence indexes to refresh from, see cal.index.
+    Nothing is recorded unless settings.CAL_OCCURRENCE_INDEX = True.
+    """
+    if not getattr(settings, 'CAL_OCCURRENCE_INDEX', False):
+        return
+    EntryItemChange.objects.bulk_create([EntryItemChange(entryitem_id=entryitem_id) for entryitem_id in entryitem_ids])
+
+def update_visibility(entryitem_ids):
+    """
+    Recomputes the denormalized per site visibility of the given entry items.
+    An entry item is visible on sites shared by its content and any of its calendars,
+    unless its content or any of its calendars are unpublished.
+    """
+    calendar_through = EntryItem.calendars.through
+    sites_through = ModelBase.sites.through
+    for ids in chunked(entryitem_ids):
+        cache.invalidate()
+        log_changes(ids)
+        EntryItemVisibility.objects.filter(entryitem__in=ids).delete()
+        content_ids = dict(EntryItem.objects.filter(id__in=ids).values_list('id', 'content'))
+        calendar_ids = {}
+        for entryitem_id, calendar_id in calendar_through.objects.filter(entryitem__in=ids).values_list('entryitem', 'calendar'):
+            calendar_ids.setdefault(entryitem_id, []).append(calendar_id)
+        if not calendar_ids:
+            continue
+
+        # calendars and content share state and sites through model base
+        modelbase_ids = set(content_ids.values())
+        for item_calendar_ids in calendar_ids.values():
+            modelbase_ids.update(item_calendar_ids)
+        states = dict(ModelBase.objects.filter(id__in=modelbase_ids).values_list('id', 'state'))
+        site_ids = {}
+        for modelbase_id, site_id in sites_through.objects.filter(modelbase__in=modelbase_ids).values_list('modelbase', 'site'):
+            site_ids.setdefault(modelbase_id, set()).add(site_id)
+
+        visibilities = []
+        for entryitem_id, item_calendar_ids in calendar_ids.items():
+            content_id = content_ids[entryitem_id]
+            item_states = [states.get(modelbase_id) for modelbase_id in item_calendar_ids + [content_id]]
+            if 'unpublished' in item_states:
+                continue
+            calendar_site_ids = set()
+            for calendar_id in item_calendar_ids:
+                calendar_site_ids.update(site_ids.get(calendar_id, []))
+            for site_id in calendar_site_ids & site_ids.get(content_id, set()):
+                visibilities.append(EntryItemVisibility(entryitem_id=entryitem_id, site_id=site_id, staging='staging' in item_states))
+        EntryItemVisibility.objects.bulk_create(visibilities)
+
+def tokenize(text):
+    """
+    Returns the set of lowercase words in text, as stored for entry search, see EntrySearchToken.
+    """
+    return set([token[:64] for token in re.findall(r'\w+', (text or u'').lower(), re.UNICODE)])
+
+def update_search_tokens(entry_ids):
+    """
+    Brings the search tokens of the given entries in line with their content's title and description,
+    only adding and removing changed tokens.
+    """
+    for ids in chunked(entry_ids):
+        tokens = {}
+        for entry_id, title, description in Entry.objects.filter(id__in=ids).values_list('id', 'content__title', 'content__description'):
+            tokens[entry_id] = tokenize(title) | tokenize(description)
+        obsolete_ids = []
+        for token_id, entry_id, token in EntrySearchToken.objects.filter(entry__in=ids).values_list('id', 'entry', 'token'):
+            if token in tokens.get(entry_id, ()):
+                tokens[entry_id].discard(token)
+            else:
+                obsolete_ids.append(token_id)
+        for obsolete in chunked(obsolete_ids):
+            EntrySearchToken.objects.filter(id__in=obsolete).delete()
+        EntrySearchToken.objects.bulk_create([EntrySearchToken(entry_id=entry_id, token=token) for entry_id, entry_tokens in tokens.items() for token in entry_tokens])
+
+def single_repeater(entry, since=None):
+    """
+    Yields entry's start datetime, unless it falls before since date.
+    """
+    if since is None or entry.start.date() >= since:
+        yield entry.start
+
+def day_repeater(entry, allowed_days=[0,1,2,3,4,5,6], since=None):
+    """
+    Yields a start datetime for each allowed day until entry's repeat until value,
+    skipping days before since date. Repeating every day steps by entry's repeat every
+    value in days, otherwise allowed days are repeated every repeat every weeks.
+    """
+    every = entry.repeat_every or 1
+    if len(set(allowed_days)) == 7:
+        days = recurrence.daily(entry.start.date(), every=every, until=entry.repeat_until, since=since)
+    else:
+        days = recurrence.weekdays(entry.start.date(), allowed_days, every=every, until=entry.repeat_until, since=since)
+    for day in days:
+        yield entry.start.replace(year=day.year, month=day.month, day=day.day)
+
+def weekly_repeater(entry, since=None):
+    """
+    Yields a start datetime for every repeat every weeks until entry's repeat until value, with the start day
+    being the same for each week, skipping weeks before since date.
+    """
+    for day in recurrence.weekly(entry.start.date(), every=entry.repeat_every or 1, until=entry.repeat_until, since=since):
+        yield entry.start.replace(year=day.year, month=day.month, day=day.day)
+
+def month_repeater(entry, rule, since=None):
+    """
+    Yields a start datetime for each date generated by monthly or yearly recurrence rule,
+    one of the cal.recurrence month generators, every repeat every months or years until
+    entry's repeat until value, skipping dates before since date.
+    """
+    for day in rule(entry.start.date(), every=entry.repeat_every or 1, until=entry.repeat_until, since=since):
+        yield entry.start.replace(year=day.year, month=day.month, day=day.day)
+
+def monthly_by_day_of_month_repeater(entry, since=None):
+    """
+    Yields a start datetime for each month until entry's repeat until value, with the start day
+    being the same day date of the month for each month, skipping months before since date
+    and months without that day.
+    """
+    return month_repeater(entry, recurrence.monthly_by_day_of_month, since=since)
+
+def monthly_by_day_of_week_repeater(entry, since=None):
+    """
+    Yields a start datetime for each month until entry's repeat until value, with the start day being
+    the same weekday in the same week of the month, i.e. the second Tuesday, skipping months before since date.
+    """
+    return month_repeater(entry, recurrence.monthly_by_day_of_week, since=since)
+
+def monthly_by_last_day_of_week_repeater(entry, since=None):
+    """
+    Yields a start datetime for each month until entry's repeat until value, with the start day being
+    the last of the month's days on the same weekday, i.e. the last Friday, skipping months before since date.
+    """
+    return month_repeater(entry, recurrence.monthly_by_last_day_of_week, since=since)
+
+def monthly_by_last_day_of_month_repeater(entry, since=None):
+    """
+    Yields a start datetime for the last day of each month until entry's repeat until value,
+    skipping months before since date.
+    """
+    return month_repeater(entry, recurrence.monthly_by_last_day_of_month, since=since)
+
+def yearly_repeater(entry, since=None):
+    """
+    Yields a start datetime for each year until entry's repeat until value, with the start day
+    being the same month and day for each year, skipping years before since date.
+    """
+    return month_repeater(entry, recurrence.yearly, since=since)
+
+@instrumented('save_handler_daily')
 def save_handler_daily(entry):
     # raise an error if wrong handler is triggered
     if entry.repeat != 'daily':
         raise Exception("In handler 'daily' for entry with repeat set as '%s'" % entry.repeat)
    
     # check for repeat until:
-    if not entry.repeat_until:
+    if not entry.repeat_until and materialization_horizon() is None:
         raise Exception("Entry should provide repeat_until value for 'daily' repeat.")
 
-    # delete all entry items related to this entry
-    # XXX: yes this is not super efficient, but results in the cleanest code.
-    entry.delete_entryitem_set()
-
-    # create entryitem linked to entry for each day until entry's repeat until value.
-    day_repeater(entry, allowed_days=[0,1,2,3,4,5,6])
+    # create entryitem linked to entry for each day until entry's repeat until value or materialization horizon.
+    return materialize(entry, day_repeater(entry, allowed_days=[0,1,2,3,4,5,6]))
 
+@instrumented('save_handler_weekdays')
 def save_handler_weekdays(entry):
     # raise an error if wrong handler is triggered
     if entry.repeat != 'weekdays':
         raise Exception("In handler 'weekdays' for entry with repeat set as '%s'" % entry.repeat)
     
     # check for repeat until:
-    if not entry.repeat_until:
+    if not entry.repeat_until and materialization_horizon() is None:
         raise Exception("Entry should provide repeat_until value for 'weekdays' repeat.")
     
-    # delete all entry items related to this entry
-    # XXX: yes this is not super efficient, but results in the cleanest code.
-    entry.delete_entryitem_set()
-    
-    # create entryitem linked to entry for each weekday until entry's repeat until value.
-    day_repeater(entry, allowed_days=[0,1,2,3,4])
+    # create entryitem linked to entry for each weekday until entry's repeat until value or materialization horizon.
+    return materialize(entry, day_repeater(entry, allowed_days=[0,1,2,3,4]))
 
+@instrumented('save_handler_weekends')
 def save_handler_weekends(entry):
     # raise an error if wrong handler is triggered
     if entry.repeat != 'weekends':
         raise Exception("In handler 'weekends' for entry with repeat set as '%s'" % entry.repeat)
     
     # check for repeat until:
-    if not entry.repeat_until:
+    if not entry.repeat_until and materialization_horizon() is None:
         raise Exception("Entry should provide repeat_until value for 'weekends' repeat.")
     
-    # delete all entry items related to this entry
-    # XXX: yes this is not super efficient, but results in the cleanest code.
-    entry.delete_entryitem_set()
-    
-    # create entryitem linked to entry for each weekend day until entry's repeat until value.
-    day_repeater(entry, allowed_days=[5,6])
+    # create entryitem linked to entry for each weekend day until entry's repeat until value or materialization horizon.
+    return materialize(entry, day_repeater(entry, allowed_days=[5,6]))
 
+@instrumented('save_handler_weekly')
 def save_handler_weekly(entry):
     # raise an error if wrong handler is triggered
     if entry.repeat != 'weekly':
         raise Exception("In handler 'weekly' for entry with repeat set as '%s'" % entry.repeat)
     
     # check for repeat until:
-    if not entry.repeat_until:
+    if not entry.repeat_until and materialization_horizon() is None:
         raise Exception("Entry should provide repeat_until value for 'weekly' repeat.")
     
-    # delete all entry items related to this entry
-    # XXX: yes this is not super efficient, but results in the cleanest code.
-    entry.delete_entryitem_set()
-        
     # create an entryitem linked to this entry for each week until entry's repeat until value, with the start day being the same for each week.
-    day = entry.start.date()
-    while day <= entry.repeat_until:
-        start = entry.start
-        start = start.replace(year=day.year, month=day.month, day=day.day)
-        end = start + entry.duration
-        entry_item = EntryItem(start=start, end=end, entry=entry, content=entry.content)
-        entry_item.save()
-
-        for calendar in entry.calendars.all():
-            entry_item.calendars.add(calendar)
-
-        day = day + timedelta(days=7)
+    return materialize(entry, weekly_repeater(entry))
 
+@instrumented('save_handler_monthly_by_day_of_month')
 def save_handler_monthly_by_day_of_month(entry):
     # raise an error if wrong handler is triggered
     if entry.repeat != 'monthly_by_day_of_month':
         raise Exception("In handler 'monthly by day of month' for entry with repeat set as '%s'" % entry.repeat)
     
     # check for repeat until:
-    if not entry.repeat_until:
+    if not entry.repeat_until and materialization_horizon() is None:
         raise Exception("Entry should provide repeat_until value for 'monthly by day of month' repeat.")
     
-    # delete all entry items related to this entry
-    # XXX: yes this is not super efficient, but results in the cleanest code.
-    entry.delete_entryitem_set()
-       
     # create an entryitem linked to entry for each month until entry's repeat until value, with the start day being the same day date of the month for each month.
-    day = entry.start.date()
-    while day <= entry.repeat_until:
-        start = entry.start
-        start = start.replace(year=day.year, month=day.month, day=day.day)
-        end = start + entry.duration
-        entry_item = EntryItem(start=start, end=end, entry=entry, content=entry.content)
-        entry_item.save()
-
-        for calendar in entry.calendars.all():
-            entry_item.calendars.add(calendar)
-        entry_item.save()
-
-        # get next valid date
-        valid_date = False
-        i = 1
-        while not valid_date:
-            try: 
-                day = day.replace(year=day.year + (day.month+i)/12, month=(day.month+i)%12, day=day.day)
-                valid_date = True
-            except ValueError:
-                i += 1
+    return materialize(entry, monthly_by_day_of_month_repeater(entry))
+
+@instrumented('save_handler_monthly_by_day_of_week')
+def save_handler_monthly_by_day_of_week(entry):
+    # raise an error if wrong handler is triggered
+    if entry.repeat != 'monthly_by_day_of_week':
+        raise Exception("In handler 'monthly by day of week' for entry with repeat set as '%s'" % entry.repeat)
+    
+    # check for repeat until:
+    if not entry.repeat_until and materialization_horizon() is None:
+        raise Exception("Entry should provide repeat_until value for 'monthly by day of week' repeat.")
+    
+    # create an entryitem linked to entry for each month, with the start day being the same weekday in the same week of the month until entry's repeat until value.
+    return materialize(entry, monthly_by_day_of_week_repeater(entry))
+
+@instrumented('save_handler_monthly_by_last_day_of_week')
+def save_handler_monthly_by_last_day_of_week(entry):
+    # raise an error if wrong handler is triggered
+    if entry.repeat != 'monthly_by_last_day_of_week':
+        raise Exception("In handler 'monthly by last day of week' for entry with repeat set as '%s'" % entry.repeat)
+    
+    # check for repeat until:
+    if not entry.repeat_until and materialization_horizon() is None:
+        raise Exception("Entry should provide repeat_until value for 'monthly by last day of week' repeat.")
+    
+    # create an entryitem linked to entry for each month, with the start day being the last of the month's days on the same weekday until entry's repeat until value.
+    return materialize(entry, monthly_by_last_day_of_week_repeater(entry))
+
+@instrumented('save_handler_monthly_by_last_day_of_month')
+def save_handler_monthly_by_last_day_of_month(entry):
+    # raise an error if wrong handler is triggered
+    if entry.repeat != 'monthly_by_last_day_of_month':
+        raise Exception("In handler 'monthly by last day of month' for entry with repeat set as '%s'" % entry.repeat)
+    
+    # check for repeat until:
+    if not entry.repeat_until and materialization_horizon() is None:
+        raise Exception("Entry should provide repeat_until value for 'monthly by last day of month' repeat.")
+    
+    # create an entryitem linked to entry for each month, with the start day being the last day of the month until entry's repeat until value.
+    return materialize(entry, monthly_by_last_day_of_month_repeater(entry))
+
+@instrumented('save_handler_yearly')
+def save_handler_yearly(entry):
+    # raise an error if wrong handler is triggered
+    if entry.repeat != 'yearly':
+        raise Exception("In handler 'yearly' for entry with repeat set as '%s'" % entry.repeat)
+    
+    # check for repeat until:
+    if not entry.repeat_until and materialization_horizon() is None:
+        raise Exception("Entry should provide repeat_until value for 'yearly' repeat.")
+    
+    # create an entryitem linked to entry for each year, with the start day being the same month and day for each year until entry's repeat until value.
+    return materialize(entry, yearly_repeater(entry))
 
 class Calendar(ModelBase):
     class Meta():
@@ -153,11 +532,27 @@ class Calendar(ModelBase):
         verbose_name_plural = "Calendars"
 
 class EntryAbstract(models.Model):
-    start = models.DateTimeField()
-    end = models.DateTimeField()
+    start = models.DateTimeField(db_index=True)
+    end = models.DateTimeField(db_index=True)
     content = models.ForeignKey(
         'panya.ModelBase',
     )
+    # content's type, denormalized so filtering by model needs no join, see EntryItemQuerySet.by_model
+    content_type = models.ForeignKey(
+        ContentType,
+        editable=False,
+        blank=True,
+        null=True,
+    )
+
+    def save(self, *args, **kwargs):
+        self.set_content_type()
+        super(EntryAbstract, self).save(*args, **kwargs)
+
+    def set_content_type(self):
+        if self.content_id is not None:
+            self.content_type_id = self.content.content_type_id
+
     class Meta():
         abstract = True
 
@@ -171,27 +566,116 @@ class Entry(EntryAbstract):
             ('weekends', 'Weekends'),
             ('weekly', 'Weekly'), 
             ('monthly_by_day_of_month', 'Monthly By Day Of Month'), 
+            ('monthly_by_day_of_week', 'Monthly By Day Of Week'),
+            ('monthly_by_last_day_of_week', 'Monthly By Last Day Of Week'),
+            ('monthly_by_last_day_of_month', 'Monthly By Last Day Of Month'),
+            ('yearly', 'Yearly'),
         ),
         default='does_not_repeat',
     )
-    # XXX: repeat every is a placeholder for now
     repeat_every = models.IntegerField(
-        editable=False,
         blank=True,
         null=True,
+        validators=[MinValueValidator(1)],
+        help_text='Repeat every so many days, weeks, months or years, depending on repeat. Defaults to 1.',
     )
     repeat_until = models.DateField(
         blank=True,
         null=True,
     )
+    materialized_until = models.DateField(
+        editable=False,
+        blank=True,
+        null=True,
+    )
+    # whether entry items are stored yet when materialization is deferred, see cal.deferred
+    materialization_status = models.CharField(
+        max_length=16,
+        choices=(
+            ('ready', 'Ready'),
+            ('pending', 'Pending'),
+            ('running', 'Running'),
+            ('failed', 'Failed'),
+        ),
+        default='ready',
+        editable=False,
+        db_index=True,
+    )
+    # identifies entries imported from iCalendar, see cal.ical.import_events
+    ical_uid = models.CharField(
+        max_length=255,
+        editable=False,
+        blank=True,
+        null=True,
+        db_index=True,
+    )
+    ical_hash = models.CharField(
+        max_length=40,
+        editable=False,
+        blank=True,
+        null=True,
+    )
     calendars = models.ManyToManyField(
         'cal.Calendar',
         related_name='entry_calendar'
     )
 
+    objects = EntryManager()
+
     def save(self, *args, **kwargs):
+        # calendars can be provided to set them before entry items are stored, i.e. for new entries
+        calendars = kwargs.pop('calendars', None)
+        # sync can be disabled to call it once related objects are saved, i.e. by the admin
+        sync = kwargs.pop('sync', True)
+
+        # optionally refuse to double-book calendars, see conflicts
+        check_conflicts = kwargs.pop('check_conflicts', None)
+        if check_conflicts is None:
+            check_conflicts = getattr(settings, 'CAL_CHECK_CONFLICTS', False)
+        if check_conflicts:
+            conflicts = self.conflicts(calendars)
+            if conflicts:
+                raise ConflictError(conflicts)
+
+        # with deferred materialization invalid repeat settings should still be refused on save,
+        # otherwise entry items are stored before returning
+        if not deferred.deferred_mode():
+            self.materialization_status = 'ready'
+        elif not virtual_mode():
+            check_repeat(self)
+
         super(Entry, self).save(*args, **kwargs)
-        # create new entry items based on repeat setting
+        if calendars is not None:
+            self.calendars = calendars
+        if sync:
+            self.sync()
+
+    def sync(self):
+        """
+        Brings this saved entry's search tokens and entry items in line with it and its exceptions,
+        deferring entry items if materialization is deferred.
+        """
+        update_search_tokens([self.id])
+
+        # occurrences are expanded at query time in virtual mode, so don't store any entry items
+        if virtual_mode():
+            self.delete_entryitem_set()
+            return
+
+        if deferred.deferred_mode():
+            # pending entries are only queued once, running ones are picked up again after they finish
+            Entry.objects.filter(id=self.id).update(materialization_status='pending')
+            self.materialization_status = 'pending'
+            deferred.schedule(self.id)
+            return
+
+        self.materialize()
+
+    def materialize(self):
+        """
+        Creates new entry items based on repeat setting.
+        Returns the number of entry item rows written.
+        """
         repeat_handlers = {
             'does_not_repeat': save_handler_does_not_repeat,
             'daily': save_handler_daily,
@@ -199,8 +683,124 @@ class Entry(EntryAbstract):
             'weekends': save_handler_weekends,
             'weekly': save_handler_weekly,
             'monthly_by_day_of_month': save_handler_monthly_by_day_of_month, 
+            'monthly_by_day_of_week': save_handler_monthly_by_day_of_week,
+            'monthly_by_last_day_of_week': save_handler_monthly_by_last_day_of_week,
+            'monthly_by_last_day_of_month': save_handler_monthly_by_last_day_of_month,
+            'yearly': save_handler_yearly,
         }
-        repeat_handlers[self.repeat](self)
+        return repeat_handlers[self.repeat](self)
+
+    def occurrence_start(self, day):
+        """
+        Returns the start datetime of this entry's occurrence on date day, raising an error if it doesn't occur then.
+        """
+        for start in self.occurrence_starts(since=day):
+            if start.date() == day:
+                return start
+            break
+        raise Exception("Entry doesn't occur on %s." % day)
+
+    def sync_occurrence(self, day):
+        """
+        Syncs only the entry item for this entry's occurrence on date day with its exception, if any.
+        Returns the number of entry item rows written.
+        """
+        start = self.occurrence_start(day)
+        # occurrences beyond the materialization limit are synced once entry items are extended to them
+        if virtual_mode() or (self.repeat != 'does_not_repeat' and day > materialization_limit(self)):
+            return 0
+        return sync_entryitems(self, [start], since=day, until=day)
+
+    def cancel_occurrence(self, day):
+        """
+        Cancels this entry's occurrence on date day, removing its entry item.
+        """
+        self.occurrence_start(day)
+        exception, created = EntryException.objects.get_or_create(entry=self, date=day)
+        exception.cancelled = True
+        exception.save()
+        return self.sync_occurrence(day)
+
+    def override_occurrence(self, day, start=None, end=None, content=None, calendars=None):
+        """
+        Overrides this entry's occurrence on date day with the provided start, end, content and/or calendars,
+        updating only its entry item. Values not provided keep their previous override, if any.
+        """
+        self.occurrence_start(day)
+        exception, created = EntryException.objects.get_or_create(entry=self, date=day)
+        exception.cancelled = False
+        if start is not None:
+            exception.start = start
+        if end is not None:
+            exception.end = end
+        if content is not None:
+            exception.content = content
+        exception.save()
+        if calendars is not None:
+            exception.calendars = calendars
+        return self.sync_occurrence(day)
+
+    def restore_occurrence(self, day):
+        """
+        Removes any exception for this entry's occurrence on date day, restoring its entry item to the entry's values.
+        """
+        self.occurrence_start(day)
+        EntryException.objects.filter(entry=self, date=day).delete()
+        return self.sync_occurrence(day)
+
+    @property
+    def occurrences_ready(self):
+        """
+        Whether this entry's entry items are stored, as they might not be yet with deferred materialization.
+        """
+        return self.materialization_status == 'ready'
+
+    def extend_entryitems(self):
+        """
+        Stores entry items from where they were last materialized up to the current materialization limit,
+        leaving previously stored entry items untouched.
+        Returns the number of entry item rows written.
+        """
+        if self.repeat == 'does_not_repeat':
+            return 0
+        if self.materialized_until is None:
+            return self.materialize()
+        since = self.materialized_until + timedelta(days=1)
+        if materialization_limit(self) < since:
+            return 0
+        return materialize(self, self.occurrence_starts(since=since), since=since)
+
+    def conflicts(self, calendars=None):
+        """
+        Returns stored entry items of other entries on calendars, defaulting to this entry's calendars, that would
+        overlap this entry's occurrences up to its materialization limit. Only the times of entry items within the span of
+        those occurrences are fetched, using the start and end index, and swept against them.
+        """
+        if calendars is None:
+            calendars = self.calendars.all() if self.pk else []
+        calendar_ids = [getattr(calendar, 'id', calendar) for calendar in calendars]
+        check_repeat(self)
+        starts = planned_starts(self)
+        if not calendar_ids or not starts:
+            return []
+        duration = self.duration
+
+        # only times are fetched for the sweep, conflicting entry items are loaded afterwards
+        rows = EntryItem.objects.filter(
+            calendars__in=calendar_ids,
+            start__lt=starts[-1] + duration,
+            end__gt=starts[0],
+        ).exclude(entry=self.pk).values_list('start', 'end', 'id').distinct().order_by()
+        occurrences = [(start, start + duration, None) for start in starts]
+        conflicting_ids = set()
+        for key, other_key in intervals.overlaps(occurrences + list(rows.iterator())):
+            # only overlaps between this entry's occurrences and other entry items are conflicts
+            if (key is None) != (other_key is None):
+                conflicting_ids.add(key or other_key)
+        items = {}
+        for ids in chunked(conflicting_ids):
+            items.update(EntryItem.objects.in_bulk(ids))
+        return sorted(items.values(), key=lambda item: item.start)
 
     def __unicode__(self):
         return "Entry for %s" % self.content.title
@@ -212,6 +812,25 @@ class Entry(EntryAbstract):
     def delete_entryitem_set(self):
         self.entryitem_set.all().delete()
 
+    def occurrence_starts(self, since=None):
+        """
+        Yields the start datetime of each of this entry's occurrences in order,
+        skipping occurrences starting before since date.
+        """
+        repeaters = {
+            'does_not_repeat': single_repeater,
+            'daily': lambda entry, since: day_repeater(entry, allowed_days=[0,1,2,3,4,5,6], since=since),
+            'weekdays': lambda entry, since: day_repeater(entry, allowed_days=[0,1,2,3,4], since=since),
+            'weekends': lambda entry, since: day_repeater(entry, allowed_days=[5,6], since=since),
+            'weekly': weekly_repeater,
+            'monthly_by_day_of_month': monthly_by_day_of_month_repeater,
+            'monthly_by_day_of_week': monthly_by_day_of_week_repeater,
+            'monthly_by_last_day_of_week': monthly_by_last_day_of_week_repeater,
+            'monthly_by_last_day_of_month': monthly_by_last_day_of_month_repeater,
+            'yearly': yearly_repeater,
+        }
+        return repeaters[self.repeat](self, since=since)
+
     @property
     def duration(self):
         return self.end - self.start
@@ -223,6 +842,13 @@ class EntryItem(EntryAbstract):
     entry = models.ForeignKey(
         'cal.Entry',
     )
+    # date of the entry occurrence this item was generated for, which might differ from its start when overridden
+    occurrence_date = models.DateField(
+        editable=False,
+        blank=True,
+        null=True,
+        db_index=True,
+    )
     calendars = models.ManyToManyField(
         'cal.Calendar',
         related_name='entryitem_calendar'
@@ -237,3 +863,180 @@ class EntryItem(EntryAbstract):
 
     class Meta():
         ordering = ('start',)
+
+class EntrySearchToken(models.Model):
+    """
+    Lowercase word of an entry's content title or description, so entries can be searched
+    with indexed lookups instead of unindexed LIKE '%term%' queries across content.
+    """
+    entry = models.ForeignKey(
+        'cal.Entry',
+        related_name='searchtoken_set',
+    )
+    token = models.CharField(
+        max_length=64,
+        db_index=True,
+    )
+
+class EntryItemChange(models.Model):
+    """
+    Log of changed entry items, read by in-process occurrence indexes to refresh incrementally.
+    Entry items aren't referenced by foreign key as deleted ones are logged too.
+    """
+    entryitem_id = models.IntegerField()
+    changed = models.DateTimeField(
+        auto_now_add=True,
+        db_index=True,
+    )
+
+class EntryException(models.Model):
+    """
+    Cancels or overrides a single occurrence of an entry, identified by the date it would originally occur on.
+    Empty override fields fall back to the entry's values. Exceptions are kept when the entry's entry items are synced.
+    """
+    entry = models.ForeignKey(
+        'cal.Entry',
+        related_name='exception_set',
+    )
+    date = models.DateField()
+    cancelled = models.BooleanField(
+        default=False,
+    )
+    start = models.DateTimeField(
+        blank=True,
+        null=True,
+    )
+    end = models.DateTimeField(
+        blank=True,
+        null=True,
+    )
+    content = models.ForeignKey(
+        'panya.ModelBase',
+        blank=True,
+        null=True,
+    )
+    calendars = models.ManyToManyField(
+        'cal.Calendar',
+        related_name='entryexception_calendar',
+        blank=True,
+    )
+
+    def __unicode__(self):
+        return "Exception on %s for %s" % (self.date, self.entry)
+
+    class Meta():
+        unique_together = (('entry', 'date'),)
+
+class EntryItemVisibility(models.Model):
+    """
+    Denormalized visibility of an entry item on a site, kept in sync through signals
+    so permitted queries need only a single indexed lookup.
+    """
+    entryitem = models.ForeignKey(
+        'cal.EntryItem',
+        related_name='visibility_set',
+    )
+    site = models.ForeignKey(
+        'sites.Site',
+    )
+    # only visible in staging mode (settings.STAGING = True)
+    staging = models.BooleanField(
+        default=False,
+    )
+
+    class Meta():
+        unique_together = (('site', 'staging', 'entryitem'),)
+
+def entryitem_ids_for_modelbase(modelbase_ids):
+    """
+    Returns ids of entry items with the given calendars or content.
+    """
+    entryitem_ids = set()
+    for ids in chunked(modelbase_ids):
+        entryitem_ids.update(EntryItem.objects.filter(content__in=ids).values_list('id', flat=True))
+        entryitem_ids.update(EntryItem.calendars.through.objects.filter(calendar__in=ids).values_list('entryitem', flat=True))
+    return entryitem_ids
+
+def entryitem_post_save(sender, instance, **kwargs):
+    update_visibility([instance.id])
+
+def entryitem_calendars_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    if action == 'pre_clear':
+        # links are gone once cleared, so collect affected items beforehand
+        if reverse:
+            instance._cleared_entryitem_ids = list(instance.entryitem_calendar.values_list('id', flat=True))
+        else:
+            instance._cleared_entryitem_ids = [instance.id]
+    elif action == 'post_clear':
+        update_visibility(getattr(instance, '_cleared_entryitem_ids', []))
+    elif action in ('post_add', 'post_remove'):
+        update_visibility(pk_set if reverse else [instance.id])
+
+def invalidate_cache(sender, instance, **kwargs):
+    # entries, exceptions and their calendars determine virtual occurrences without any entry items changing
+    if kwargs.get('action', 'post_').startswith('post_'):
+        cache.invalidate()
+
+def entryitem_post_delete(sender, instance, **kwargs):
+    cache.invalidate()
+    log_changes([instance.id])
+
+def modelbase_in_use(modelbase_ids):
+    """
+    Whether any of the given model base objects are calendars or content of entries or their exceptions,
+    so changing them can change calendar results. Other content, i.e. articles, doesn't affect them.
+    """
+    for ids in chunked(modelbase_ids):
+        if Calendar.objects.filter(id__in=ids).exists() or Entry.objects.filter(content__in=ids).exists() or EntryException.objects.filter(content__in=ids).exists():
+            return True
+    return False
+
+def modelbase_post_save(sender, instance, **kwargs):
+    if isinstance(instance, ModelBase) and (isinstance(instance, Calendar) or modelbase_in_use([instance.id])):
+        # virtual occurrences have no entry items to update visibility of, so always invalidate
+        cache.invalidate()
+        update_visibility(entryitem_ids_for_modelbase([instance.id]))
+        update_search_tokens(Entry.objects.filter(content=instance.id).values_list('id', flat=True))
+
+def modelbase_pre_delete(sender, instance, **kwargs):
+    if isinstance(instance, ModelBase):
+        # links are deleted along with instance, so collect affected items beforehand
+        instance._deleted_entryitem_ids = entryitem_ids_for_modelbase([instance.id])
+
+def modelbase_post_delete(sender, instance, **kwargs):
+    # deleting content deletes its entries, which invalidates, but calendars' entry links go without signals
+    if isinstance(instance, Calendar):
+        cache.invalidate()
+    update_visibility(getattr(instance, '_deleted_entryitem_ids', []))
+
+def modelbase_sites_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    if action == 'pre_clear':
+        # links are gone once cleared, so collect affected items beforehand
+        if reverse:
+            instance._cleared_modelbase_ids = list(sender.objects.filter(site=instance).values_list('modelbase', flat=True))
+        else:
+            instance._cleared_modelbase_ids = [instance.id]
+        instance._cleared_entryitem_ids = entryitem_ids_for_modelbase(instance._cleared_modelbase_ids)
+    elif action == 'post_clear':
+        if modelbase_in_use(getattr(instance, '_cleared_modelbase_ids', [])):
+            cache.invalidate()
+        update_visibility(getattr(instance, '_cleared_entryitem_ids', []))
+    elif action in ('post_add', 'post_remove'):
+        modelbase_ids = pk_set if reverse else [instance.id]
+        if modelbase_in_use(modelbase_ids):
+            cache.invalidate()
+            update_visibility(entryitem_ids_for_modelbase(modelbase_ids))
+
+signals.post_save.connect(entryitem_post_save, sender=EntryItem)
+signals.m2m_changed.connect(entryitem_calendars_changed, sender=EntryItem.calendars.through)
+signals.post_save.connect(invalidate_cache, sender=Entry)
+signals.post_delete.connect(invalidate_cache, sender=Entry)
+signals.m2m_changed.connect(invalidate_cache, sender=Entry.calendars.through)
+signals.post_save.connect(invalidate_cache, sender=EntryException)
+signals.post_delete.connect(invalidate_cache, sender=EntryException)
+signals.m2m_changed.connect(invalidate_cache, sender=EntryException.calendars.through)
+signals.post_delete.connect(entryitem_post_delete, sender=EntryItem)
+signals.post_save.connect(modelbase_post_save)
+signals.pre_delete.connect(modelbase_pre_delete)
+signals.post_delete.connect(modelbase_post_delete)
+signals.m2m_changed.connect(modelbase_sites_changed, sender=ModelBase.sites.through)
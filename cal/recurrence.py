@@ -0,0 +1,123 @@
+"""
+Recurrence generators computing occurrence dates arithmetically. Each generator lazily yields
+dates from start, every so many periods, up to and including until (if given), skipping
+dates before since (if given) by stepping straight to the first period on or after it.
+"""
+import calendar
+from datetime import date, timedelta
+
+def first_period(start, since, period_days):
+    """
+    Returns the number of whole periods of period_days from start to the first period starting on or after since.
+    """
+    if since is None or since <= start:
+        return 0
+    return ((since - start).days + period_days - 1) // period_days
+
+def daily(start, every=1, until=None, since=None):
+    """
+    Yields every nth day from start.
+    """
+    step = timedelta(days=every)
+    day = start + step * first_period(start, since, every)
+    while until is None or day <= until:
+        yield day
+        day += step
+
+def weekly(start, every=1, until=None, since=None):
+    """
+    Yields the same day of the week as start, every nth week.
+    """
+    return daily(start, every=every * 7, until=until, since=since)
+
+def weekdays(start, allowed_days, every=1, until=None, since=None):
+    """
+    Yields the allowed days of the week (0 being Monday) in every nth week from the week of start,
+    without visiting days that aren't allowed.
+    """
+    offsets = [timedelta(days=weekday) for weekday in sorted(set(allowed_days))]
+    if not offsets:
+        return
+    step = timedelta(days=every * 7)
+    week = start - timedelta(days=start.weekday())
+    # the week containing since might still have allowed days on or after it
+    if since is not None and since > start:
+        week += step * ((since - week).days // (every * 7))
+    while True:
+        for offset in offsets:
+            day = week + offset
+            if until is not None and day > until:
+                return
+            if day >= start and (since is None or day >= since):
+                yield day
+        week += step
+
+def months(start, every=1, until=None, since=None):
+    """
+    Yields (year, month) tuples for every nth month from the month of start,
+    ending with the month containing until.
+    """
+    index = start.year * 12 + start.month - 1
+    if since is not None and since > start:
+        index += ((since.year * 12 + since.month - 1) - index) // every * every
+    while until is None or index <= until.year * 12 + until.month - 1:
+        yield index // 12, index % 12 + 1
+        index += every
+
+def month_days(start, day_of_month, every=1, until=None, since=None):
+    """
+    Yields the date computed by day_of_month(year, month) for every nth month from start,
+    skipping months for which it returns None.
+    """
+    for year, month in months(start, every=every, until=until, since=since):
+        day = day_of_month(year, month)
+        if day is None or day < start or (since is not None and day < since):
+            continue
+        if until is not None and day > until:
+            return
+        yield day
+
+def monthly_by_day_of_month(start, every=1, until=None, since=None):
+    """
+    Yields the day of the month of start every nth month, skipping months that are too short.
+    """
+    def day_of_month(year, month):
+        if start.day <= calendar.monthrange(year, month)[1]:
+            return date(year, month, start.day)
+    return month_days(start, day_of_month, every=every, until=until, since=since)
+
+def monthly_by_day_of_week(start, every=1, until=None, since=None):
+    """
+    Yields the nth weekday of the month matching start every nth month, i.e. the second Tuesday,
+    skipping months without a fifth such weekday when start falls on one.
+    """
+    nth = (start.day - 1) // 7
+    def day_of_month(year, month):
+        first = date(year, month, 1)
+        day = first + timedelta(days=(start.weekday() - first.weekday()) % 7 + nth * 7)
+        if day.month == month:
+            return day
+    return month_days(start, day_of_month, every=every, until=until, since=since)
+
+def monthly_by_last_day_of_week(start, every=1, until=None, since=None):
+    """
+    Yields the last weekday of the month matching start's weekday every nth month, i.e. the last Friday.
+    """
+    def day_of_month(year, month):
+        last = date(year, month, calendar.monthrange(year, month)[1])
+        return last - timedelta(days=(last.weekday() - start.weekday()) % 7)
+    return month_days(start, day_of_month, every=every, until=until, since=since)
+
+def monthly_by_last_day_of_month(start, every=1, until=None, since=None):
+    """
+    Yields the last day of the month every nth month.
+    """
+    def day_of_month(year, month):
+        return date(year, month, calendar.monthrange(year, month)[1])
+    return month_days(start, day_of_month, every=every, until=until, since=since)
+
+def yearly(start, every=1, until=None, since=None):
+    """
+    Yields the month and day of start every nth year, skipping non-leap years for February 29th.
+    """
+    return monthly_by_day_of_month(start, every=every * 12, until=until, since=since)
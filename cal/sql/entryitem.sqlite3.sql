@@ -0,0 +1,4 @@
+-- composite index for overlap queries (start < range end and end > range start) sorted by start
+CREATE INDEX cal_entryitem_start_end ON cal_entryitem (start, "end");
+-- composite index for filtering by model within a time range, see EntryItemQuerySet.by_model
+CREATE INDEX cal_entryitem_content_type_start ON cal_entryitem (content_type_id, start);
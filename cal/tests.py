@@ -3,10 +3,12 @@ import unittest
 
 from django.conf import settings
 from django.contrib.sites.models import Site
-from django.db import models as django_models
+from django.db import connection, models as django_models
 
 
-from cal import models
+from cal import cache, deferred, ical, models
+from cal.instrumentation import operation_measured
+from cal.managers import EntryItemQuerySet
 from cal.models import Calendar, Entry, EntryItem
 from panya.models import ModelBase
 
@@ -303,7 +305,7 @@ class EntrySaveHandlersTestCase(unittest.TestCase):
         entry.repeat_until = (entry.start + timedelta(days=366)).date()
         handler(entry)
         entries = models.EntryItem.objects.filter(entry=entry)
-        self.failUnlessEqual(entries.count(), 7)
+        self.failUnlessEqual(entries.count(), 8)
         
         # check correct generation
         starts = set()
@@ -324,12 +326,406 @@ class EntrySaveHandlersTestCase(unittest.TestCase):
             self.failUnlessEqual(list(ent.calendars.all()), list(entry.calendars.all()))
         
         # entry items should not have the same starts
-        self.failUnlessEqual(len(starts), 7)
+        self.failUnlessEqual(len(starts), 8)
         
         # subsequent save should still only create an entryitem linked to this entry for each month until entry's repeat until value, with the start day being the same day date of the month for each month.
         handler(entry)
         entries = models.EntryItem.objects.filter(entry=entry)
-        self.failUnlessEqual(entries.count(), 7)
+        self.failUnlessEqual(entries.count(), 8)
+
+    def test_save_query_count(self):
+        # number of queries should not depend on the number of occurrences written, both when
+        # inserting and resaving. Sizes are kept within a single insert batch on every backend,
+        # as some split inserts at 999 query parameters (i.e. SQLite).
+        insert_counts = []
+        resave_counts = []
+        for days in (7, 120):
+            entry = models.Entry(
+                start=datetime(year=2000, month=1, day=1, hour=1, minute=1), 
+                end=datetime(year=2000, month=1, day=1, hour=2, minute=1),
+                repeat="daily",
+                repeat_until = (datetime(year=2000, month=1, day=1) + timedelta(days=days)).date(),
+                content=self.content,
+            )
+
+            connection.use_debug_cursor = True
+            start_count = len(connection.queries)
+            entry.save(calendars=[self.calendar])
+            insert_counts.append(len(connection.queries) - start_count)
+            start_count = len(connection.queries)
+            entry.save()
+            resave_counts.append(len(connection.queries) - start_count)
+            connection.use_debug_cursor = False
+
+            # calendars should be linked to every entry item
+            self.failUnlessEqual(models.EntryItem.calendars.through.objects.filter(entryitem__entry=entry).count(), days + 1)
+            entry.delete()
+
+        self.failUnlessEqual(insert_counts[0], insert_counts[1])
+        self.failUnlessEqual(resave_counts[0], resave_counts[1])
+
+    def test_sync_entryitems(self):
+        entry = models.Entry(
+            start=datetime(year=2000, month=1, day=1, hour=1, minute=1), 
+            end=datetime(year=2000, month=1, day=1, hour=2, minute=1),
+            repeat="daily",
+            repeat_until = datetime(year=2000, month=1, day=30).date(),
+            content=self.content,
+        )
+        entry.save()
+        original_ids = set(entry.entryitem_set.values_list('id', flat=True))
+        self.failUnlessEqual(len(original_ids), 30)
+
+        # extending repeat until should only add the missing entry items
+        entry.repeat_until = datetime(year=2000, month=2, day=6).date()
+        entry.save()
+        ids = set(entry.entryitem_set.values_list('id', flat=True))
+        self.failUnlessEqual(len(ids), 37)
+        self.failUnless(original_ids.issubset(ids))
+
+        # shortening repeat until should only remove obsolete entry items
+        entry.repeat_until = datetime(year=2000, month=1, day=20).date()
+        entry.save()
+        ids = set(entry.entryitem_set.values_list('id', flat=True))
+        self.failUnlessEqual(len(ids), 20)
+        self.failUnless(ids.issubset(original_ids))
+
+        # changing times should update entry items in place
+        entry.start = entry.start + timedelta(hours=1)
+        entry.end = entry.end + timedelta(hours=2)
+        entry.save()
+        self.failUnlessEqual(set(entry.entryitem_set.values_list('id', flat=True)), ids)
+        for ent in entry.entryitem_set.all():
+            self.failUnlessEqual(ent.start.time(), entry.start.time())
+            self.failUnlessEqual(ent.duration, entry.duration)
+
+    def test_resave(self):
+        entry = models.Entry(
+            start=datetime(year=2000, month=1, day=1, hour=1, minute=1), 
+            end=datetime(year=2000, month=1, day=1, hour=2, minute=1),
+            repeat="daily",
+            repeat_until = datetime(year=2000, month=1, day=30).date(),
+            content=self.content,
+        )
+        entry.save()
+        entry.calendars.add(self.calendar)
+        entry.save()
+        ids = set(entry.entryitem_set.values_list('id', flat=True))
+        self.failUnlessEqual(len(ids), 30)
+
+        # resaving an unchanged entry should neither add entry items nor calendar links
+        entry.save()
+        entry.save()
+        self.failUnlessEqual(set(entry.entryitem_set.values_list('id', flat=True)), ids)
+        self.failUnlessEqual(models.EntryItem.calendars.through.objects.filter(entryitem__entry=entry).count(), 30)
+
+        # saving without syncing should leave entry items for a single later sync, as the admin does
+        entry.repeat_until = datetime(year=2000, month=1, day=31).date()
+        entry.save(sync=False)
+        self.failUnlessEqual(entry.entryitem_set.count(), 30)
+        entry.sync()
+        self.failUnlessEqual(entry.entryitem_set.count(), 31)
+        entry.delete()
+
+    def test_materialization_horizon(self):
+        settings.CAL_MATERIALIZATION_HORIZON = 10
+        try:
+            today = datetime.now().replace(hour=1, minute=1, second=0, microsecond=0)
+            entry = models.Entry(
+                start=today,
+                end=today + timedelta(hours=1),
+                repeat="daily",
+                content=self.content,
+            )
+            entry.save()
+            entry.calendars.add(self.calendar)
+            entry.save()
+
+            # entries without repeat until should only be materialized up to the horizon
+            self.failUnlessEqual(entry.entryitem_set.count(), 11)
+            self.failUnlessEqual(entry.materialized_until, today.date() + timedelta(days=10))
+
+            # extending should only add entry items for days past the previous limit
+            ids = set(entry.entryitem_set.values_list('id', flat=True))
+            settings.CAL_MATERIALIZATION_HORIZON = 20
+            self.failUnlessEqual(entry.extend_entryitems(), 10)
+            self.failUnless(ids.issubset(set(entry.entryitem_set.values_list('id', flat=True))))
+            self.failUnlessEqual(models.EntryItem.calendars.through.objects.filter(entryitem__entry=entry).count(), 21)
+            
+            # extending again should not write anything
+            self.failIf(entry.extend_entryitems())
+        finally:
+            settings.CAL_MATERIALIZATION_HORIZON = None
+
+    def test_instrumentation(self):
+        measured = []
+        def collect(sender, **kwargs):
+            measured.append(kwargs)
+        operation_measured.connect(collect)
+        try:
+            entry = models.Entry(
+                start=datetime(year=2000, month=1, day=1, hour=1, minute=1), 
+                end=datetime(year=2000, month=1, day=1, hour=2, minute=1),
+                repeat="daily",
+                repeat_until = datetime(year=2000, month=1, day=30).date(),
+                content=self.content,
+            )
+            entry.save()
+
+            # repeat handlers should report rows written and elapsed time
+            handler_measurements = [kwargs for kwargs in measured if kwargs['operation'] == 'save_handler_daily']
+            self.failUnlessEqual(len(handler_measurements), 1)
+            self.failUnlessEqual(handler_measurements[0]['rows'], 30)
+            self.failUnless(handler_measurements[0]['elapsed'] >= 0)
+
+            # querysets should be measured as they are evaluated
+            del measured[:]
+            queryset = models.EntryItem.permitted.by_range(entry.start, entry.end + timedelta(days=30))
+            self.failIf(measured)
+            list(queryset)
+            self.failUnlessEqual([kwargs['operation'] for kwargs in measured], ['PermittedManager.by_range'])
+
+            # queries recorded only for counting shouldn't accumulate
+            settings.CAL_COUNT_QUERIES = True
+            del measured[:]
+            query_count = len(connection.queries)
+            entry.save()
+            self.failUnless(measured[0]['queries'])
+            self.failUnlessEqual(len(connection.queries), query_count)
+        finally:
+            settings.CAL_COUNT_QUERIES = False
+            operation_measured.disconnect(collect)
+
+    def test_bulk_create_with_occurrences(self):
+        start = datetime(year=2000, month=1, day=1, hour=1, minute=1)
+        valid_entries = [models.Entry(start=start, end=start + timedelta(hours=1), repeat=repeat, repeat_until=(start + timedelta(days=30)).date(), content=self.content) for repeat in ('does_not_repeat', 'daily', 'weekly')]
+        invalid_entry = models.Entry(start=start, end=start + timedelta(hours=1), repeat='daily', content=self.content)
+
+        created, errors = models.Entry.objects.bulk_create_with_occurrences(valid_entries + [invalid_entry], calendars=[self.calendar])
+
+        # invalid entries should be reported without aborting the batch
+        self.failUnlessEqual(created, valid_entries)
+        self.failUnlessEqual([entry for entry, error in errors], [invalid_entry])
+        self.failIf(invalid_entry.id)
+
+        # entry items and calendar links should be created as on save
+        for entry, count in zip(valid_entries, (1, 31, 5)):
+            self.failUnlessEqual(list(entry.calendars.all()), [self.calendar])
+            self.failUnlessEqual(entry.entryitem_set.count(), count)
+            for ent in entry.entryitem_set.all():
+                self.failUnlessEqual(ent.duration, entry.duration)
+                self.failUnlessEqual(list(ent.calendars.all()), [self.calendar])
+
+            # subsequent saves should leave entry items in place
+            ids = set(entry.entryitem_set.values_list('id', flat=True))
+            entry.save()
+            self.failUnlessEqual(set(entry.entryitem_set.values_list('id', flat=True)), ids)
+
+    def test_monthly_and_yearly_repeats(self):
+        # second Tuesday of the month
+        start = datetime(year=2010, month=1, day=12, hour=1, minute=1)
+        entry = models.Entry(
+            start=start,
+            end=start + timedelta(hours=1),
+            repeat="monthly_by_day_of_week",
+            repeat_until=datetime(2010, 4, 30).date(),
+            content=self.content,
+        )
+        entry.save()
+        self.failUnlessEqual([item.start.date() for item in entry.entryitem_set.all()], [datetime(2010, 1, 12).date(), datetime(2010, 2, 9).date(), datetime(2010, 3, 9).date(), datetime(2010, 4, 13).date()])
+        
+        # last Friday of the month, every other month
+        entry.start = datetime(year=2010, month=1, day=29, hour=1, minute=1)
+        entry.end = entry.start + timedelta(hours=1)
+        entry.repeat = 'monthly_by_last_day_of_week'
+        entry.repeat_every = 2
+        entry.repeat_until = datetime(2010, 7, 31).date()
+        entry.save()
+        self.failUnlessEqual([item.start.date() for item in entry.entryitem_set.all()], [datetime(2010, 1, 29).date(), datetime(2010, 3, 26).date(), datetime(2010, 5, 28).date(), datetime(2010, 7, 30).date()])
+        
+        # last day of the month
+        entry.start = datetime(year=2010, month=1, day=31, hour=1, minute=1)
+        entry.end = entry.start + timedelta(hours=1)
+        entry.repeat = 'monthly_by_last_day_of_month'
+        entry.repeat_every = None
+        entry.repeat_until = datetime(2010, 4, 30).date()
+        entry.save()
+        self.failUnlessEqual([item.start.day for item in entry.entryitem_set.all()], [31, 28, 31, 30])
+        
+        # yearly on February 29th should skip non-leap years
+        entry.start = datetime(year=2008, month=2, day=29, hour=1, minute=1)
+        entry.end = entry.start + timedelta(hours=1)
+        entry.repeat = 'yearly'
+        entry.repeat_until = datetime(2016, 12, 31).date()
+        entry.save()
+        self.failUnlessEqual([item.start.year for item in entry.entryitem_set.all()], [2008, 2012, 2016])
+        
+        # iCalendar rules should match repeat settings
+        entry.start = datetime(year=2010, month=1, day=12, hour=1, minute=1)
+        entry.repeat = 'monthly_by_day_of_week'
+        entry.repeat_until = None
+        self.failUnlessEqual(ical.rrule(entry), 'FREQ=MONTHLY;BYDAY=2TU')
+        self.failUnlessEqual(ical.map_rrule(ical.parse_rrule('FREQ=MONTHLY;BYDAY=2TU'), entry.start), 'monthly_by_day_of_week')
+        entry.delete()
+
+    def test_deferred_materialization(self):
+        settings.CAL_DEFERRED_MATERIALIZATION = 'queue'
+        try:
+            start = datetime(year=2010, month=1, day=1, hour=1, minute=1)
+            entry = models.Entry(
+                start=start,
+                end=start + timedelta(hours=1),
+                repeat="daily",
+                repeat_until=datetime(2010, 1, 10).date(),
+                content=self.content,
+            )
+            entry.save()
+            
+            # entry items should only be stored once pending entries are drained
+            self.failUnlessEqual(entry.materialization_status, 'pending')
+            self.failIf(entry.occurrences_ready)
+            self.failUnlessEqual(entry.entryitem_set.count(), 0)
+            
+            # repeated saves should be coalesced into a single job
+            entry.save()
+            self.failUnlessEqual(deferred.run_pending(), 1)
+            self.failUnlessEqual(deferred.run_pending(), 0)
+            entry = models.Entry.objects.get(id=entry.id)
+            self.failUnless(entry.occurrences_ready)
+            self.failUnlessEqual(entry.entryitem_set.count(), 10)
+            
+            # invalid repeat settings should still be refused on save
+            entry.repeat_until = None
+            self.failUnlessRaises(Exception, entry.save)
+        finally:
+            settings.CAL_DEFERRED_MATERIALIZATION = None
+        entry.delete()
+
+    def test_deferred_materialization_threads(self):
+        # workers aren't started so the test can play a worker's part, their connections can't see the test database
+        settings.CAL_DEFERRED_MATERIALIZATION = 'thread'
+        settings.CAL_DEFERRED_WORKERS = 0
+        try:
+            start = datetime(year=2010, month=1, day=1, hour=1, minute=1)
+            entry = models.Entry(
+                start=start,
+                end=start + timedelta(hours=1),
+                repeat="daily",
+                repeat_until=datetime(2010, 1, 10).date(),
+                content=self.content,
+            )
+            deferred.wakeup.clear()
+            entry.save()
+
+            # saves should wake up workers, which drain pending entries from the database
+            self.failUnless(deferred.wakeup.isSet())
+            self.failUnlessEqual(deferred.poll(0), 1)
+            self.failIf(deferred.wakeup.isSet())
+            self.failUnlessEqual(models.Entry.objects.get(id=entry.id).entryitem_set.count(), 10)
+
+            # entries committed after workers woke up should be picked up on their next poll
+            models.Entry.objects.filter(id=entry.id).update(materialization_status='pending')
+            self.failUnlessEqual(deferred.poll(0), 1)
+            self.failUnless(models.Entry.objects.get(id=entry.id).occurrences_ready)
+        finally:
+            settings.CAL_DEFERRED_MATERIALIZATION = None
+            settings.CAL_DEFERRED_WORKERS = 2
+        entry.delete()
+
+    def test_occurrence_exceptions(self):
+        start = datetime(year=2010, month=1, day=4, hour=10)
+        entry = models.Entry(
+            start=start,
+            end=start + timedelta(hours=1),
+            repeat="weekly",
+            repeat_until=datetime(2010, 2, 28).date(),
+            content=self.content,
+        )
+        entry.save()
+        entry.calendars.add(self.calendar)
+        entry.save()
+        original_ids = dict(entry.entryitem_set.values_list('occurrence_date', 'id'))
+        self.failUnlessEqual(len(original_ids), 8)
+        
+        # cancelling an occurrence should only remove its entry item
+        cancelled = datetime(2010, 1, 11).date()
+        self.failUnlessEqual(entry.cancel_occurrence(cancelled), 1)
+        self.failIf(entry.entryitem_set.filter(occurrence_date=cancelled).exists())
+        
+        # overriding an occurrence should only update its entry item
+        overridden = datetime(2010, 1, 18).date()
+        other_calendar = models.Calendar()
+        other_calendar.save()
+        other_content = ModelBase(title='special')
+        other_content.save()
+        entry.override_occurrence(overridden, start=datetime(2010, 1, 19, 12), end=datetime(2010, 1, 19, 14), content=other_content, calendars=[other_calendar])
+        item = entry.entryitem_set.get(occurrence_date=overridden)
+        self.failUnlessEqual(item.id, original_ids[overridden])
+        self.failUnlessEqual((item.start, item.end, item.content_id), (datetime(2010, 1, 19, 12), datetime(2010, 1, 19, 14), other_content.id))
+        self.failUnlessEqual(list(item.calendars.all()), [other_calendar])
+        
+        # occurrences that don't exist can't be overridden
+        self.failUnlessRaises(Exception, entry.cancel_occurrence, datetime(2010, 1, 12).date())
+        
+        # regenerating the series should keep exceptions and leave other entry items untouched
+        entry.repeat_until = datetime(2010, 3, 31).date()
+        entry.save()
+        self.failIf(entry.entryitem_set.filter(occurrence_date=cancelled).exists())
+        item = entry.entryitem_set.get(occurrence_date=overridden)
+        self.failUnlessEqual((item.id, item.start, item.content_id), (original_ids[overridden], datetime(2010, 1, 19, 12), other_content.id))
+        ids = dict(entry.entryitem_set.values_list('occurrence_date', 'id'))
+        for day, entryitem_id in original_ids.items():
+            if day != cancelled:
+                self.failUnlessEqual(ids[day], entryitem_id)
+        
+        # restoring an occurrence should bring back the entry's values
+        entry.restore_occurrence(cancelled)
+        entry.restore_occurrence(overridden)
+        item = entry.entryitem_set.get(occurrence_date=overridden)
+        self.failUnlessEqual((item.start, item.content_id), (datetime(2010, 1, 18, 10), self.content.id))
+        self.failUnlessEqual(list(item.calendars.all()), [self.calendar])
+        self.failUnless(entry.entryitem_set.filter(occurrence_date=cancelled).exists())
+        
+        # exceptions should be exported to iCalendar
+        entry.cancel_occurrence(cancelled)
+        entry.override_occurrence(overridden, start=datetime(2010, 1, 19, 12))
+        feed = ''.join(ical.feed(models.Entry.objects.filter(id=entry.id)))
+        self.failUnless('EXDATE:20100111T100000' in feed)
+        self.failUnless('RECURRENCE-ID:20100118T100000' in feed)
+        entry.delete()
+
+    def test_repeat_every(self):
+        start = datetime(year=2010, month=1, day=2, hour=1, minute=1)
+        entry = models.Entry(
+            start=start,
+            end=start + timedelta(hours=1),
+            repeat="daily",
+            repeat_every=3,
+            repeat_until=datetime(2010, 1, 14).date(),
+            content=self.content,
+        )
+        entry.save()
+        
+        # daily entries should repeat every so many days
+        self.failUnlessEqual([item.start.day for item in entry.entryitem_set.all()], [2, 5, 8, 11, 14])
+        
+        # weekly entries should repeat every so many weeks
+        entry.repeat = 'weekly'
+        entry.repeat_every = 2
+        entry.repeat_until = datetime(2010, 2, 28).date()
+        entry.save()
+        self.failUnlessEqual([item.start.date() for item in entry.entryitem_set.all()], [datetime(2010, 1, 2).date(), datetime(2010, 1, 16).date(), datetime(2010, 1, 30).date(), datetime(2010, 2, 13).date(), datetime(2010, 2, 27).date()])
+        
+        # weekend entries should repeat on weekend days every so many weeks
+        entry.repeat = 'weekends'
+        entry.repeat_until = datetime(2010, 1, 31).date()
+        entry.save()
+        self.failUnlessEqual([item.start.day for item in entry.entryitem_set.all()], [2, 3, 16, 17, 30, 31])
+        
+        # occurrences should be generated lazily from since
+        starts = entry.occurrence_starts(since=datetime(2010, 1, 17).date())
+        self.failUnlessEqual(starts.next(), datetime(2010, 1, 17, 1, 1))
+        entry.delete()
 
 class PermittedManagerTestCase(unittest.TestCase):
     def setUp(self):
@@ -449,6 +845,47 @@ class PermittedManagerTestCase(unittest.TestCase):
         queryset = EntryItem.permitted.all()
         self.failIf(queryset.count())
 
+    def test_visibility(self):
+        # create published calendars
+        published_cal = Calendar(title='title', state='published')
+        published_cal.save()
+        published_cal.sites.add(self.web_site)
+        published_cal.save()
+        other_published_cal = Calendar(title='title', state='published')
+        other_published_cal.save()
+        other_published_cal.sites.add(self.web_site)
+        other_published_cal.save()
+        
+        # create published content
+        content = ModelBase(title='title', state='published')
+        content.save()
+        content.sites.add(self.web_site)
+        content.save()
+        
+        entry_obj = Entry(start=datetime.now(), end=datetime.now() + timedelta(days=1), repeat="daily", repeat_until=(datetime.now() + timedelta(days=30)).date(), content=content)
+        entry_obj.save()
+        entry_obj.calendars.add(published_cal)
+        entry_obj.calendars.add(other_published_cal)
+        entry_obj.save()
+
+        # entry items should only be returned once, regardless of the number of calendars
+        self.failUnlessEqual(EntryItem.permitted.count(), 31)
+        
+        # unpublishing a calendar should hide its entry items
+        other_published_cal.state = 'unpublished'
+        other_published_cal.save()
+        self.failIf(EntryItem.permitted.count())
+        
+        # removing the unpublished calendar should show entry items again
+        entry_obj.calendars.remove(other_published_cal)
+        entry_obj.save()
+        self.failUnlessEqual(EntryItem.permitted.count(), 31)
+
+        # removing content from the site should hide its entry items
+        content.sites.remove(self.web_site)
+        self.failIf(EntryItem.permitted.count())
+        Entry.objects.all().delete()
+
     def test_by_model(self):
         # create published calendar
         published_cal = Calendar(title='title', state='published')
@@ -484,6 +921,15 @@ class PermittedManagerTestCase(unittest.TestCase):
         queryset = EntryItem.permitted.by_model(WantedContent)
         for obj in queryset:
             self.failUnlessEqual(obj.content.class_name, 'WantedContent')
+        self.failUnless(queryset.count())
+        
+        # filtering should use the denormalized content type rather than joining content
+        self.failIf(ModelBase._meta.db_table in str(queryset.query))
+        self.failUnlessEqual(entry_obj.content_type, unwanted_content.content_type)
+        
+        # should return entry items for content of any of the provided models.
+        queryset = EntryItem.permitted.by_models(WantedContent, UnwantedContent)
+        self.failUnlessEqual(set([obj.content.class_name for obj in queryset]), set(['WantedContent', 'UnwantedContent']))
     
     def test_now(self):
         # create published calendar
@@ -511,6 +957,67 @@ class PermittedManagerTestCase(unittest.TestCase):
             self.failUnless(entry_item.start < datetime.now())
             self.failUnless(entry_item.end > datetime.now())
 
+    def test_cached_now(self):
+        # create published calendar
+        published_cal = Calendar(title='title', state='published')
+        published_cal.save()
+        published_cal.sites.add(self.web_site)
+        published_cal.save()
+        
+        # create published content
+        content = ModelBase(title='title', state='published')
+        content.save()
+        content.sites.add(self.web_site)
+        content.save()
+        
+        # create entries
+        entry_obj = Entry(start=datetime.now() - timedelta(hours=1), end=datetime.now() + timedelta(hours=1), repeat="daily", repeat_until=(datetime.now() + timedelta(days=30)).date(), content=content)
+        entry_obj.save()
+        entry_obj.calendars.add(published_cal)
+        entry_obj.save()
+
+        # should return currently active entry items
+        result = EntryItem.permitted.cached_now()
+        self.failUnlessEqual(result, list(EntryItem.permitted.now()))
+        self.failUnlessEqual(len(result), 1)
+
+        # subsequent calls should be served from cache
+        connection.use_debug_cursor = True
+        start_count = len(connection.queries)
+        self.failUnlessEqual(EntryItem.permitted.cached_now(), result)
+        self.failUnlessEqual(len(connection.queries), start_count)
+        connection.use_debug_cursor = False
+
+        # content unrelated to entries shouldn't invalidate cached results
+        generation = cache.generation()
+        unrelated = ModelBase(title='unrelated', state='published')
+        unrelated.save()
+        unrelated.sites.add(self.web_site)
+        self.failUnlessEqual(cache.generation(), generation)
+
+        # changes should invalidate the cached result
+        published_cal.state = 'unpublished'
+        published_cal.save()
+        self.failIf(EntryItem.permitted.cached_now())
+        Entry.objects.all().delete()
+
+        # entry changes should invalidate cached virtual occurrences, which have no entry items
+        published_cal.state = 'published'
+        published_cal.save()
+        settings.CAL_VIRTUAL_OCCURRENCES = True
+        try:
+            entry_obj = Entry(start=datetime.now() - timedelta(hours=1), end=datetime.now() + timedelta(hours=1), content=content)
+            entry_obj.save()
+            entry_obj.calendars.add(published_cal)
+            self.failUnlessEqual(len(EntryItem.permitted.cached_now()), 1)
+            entry_obj.start = datetime.now() + timedelta(hours=2)
+            entry_obj.end = datetime.now() + timedelta(hours=3)
+            entry_obj.save()
+            self.failIf(EntryItem.permitted.cached_now())
+        finally:
+            settings.CAL_VIRTUAL_OCCURRENCES = False
+            Entry.objects.all().delete()
+
     def test_by_range(self):
         # create published calendar
         published_cal = Calendar(title='title', state='published')
@@ -577,6 +1084,132 @@ class PermittedManagerTestCase(unittest.TestCase):
         # entry starting in range but ending after range should be in result
         self.failUnless(start_contained_entryitem in result)
     
+    def test_by_window(self):
+        # create published calendar
+        published_cal = Calendar(title='title', state='published')
+        published_cal.save()
+        published_cal.sites.add(self.web_site)
+        published_cal.save()
+        
+        # create published content
+        content = ModelBase(title='title', state='published')
+        content.save()
+        content.sites.add(self.web_site)
+        content.save()
+        
+        start = datetime.now()
+        end = start + timedelta(days=2)
+
+        # create entryitem that spans the window
+        spanning_entryitem = EntryItem(entry_id=1, start=start - timedelta(days=1), end=end + timedelta(days=1), content=content)
+        spanning_entryitem.save()
+        spanning_entryitem.calendars.add(published_cal)
+        
+        # create entryitem that is contained in the window
+        contained_entryitem = EntryItem(entry_id=1, start=start + timedelta(hours=1), end=start + timedelta(hours=2), content=content)
+        contained_entryitem.save()
+        contained_entryitem.calendars.add(published_cal)
+        
+        result = EntryItem.permitted.by_window(start, end)
+        
+        # entry item start and end should be contained within the window
+        for item in result:
+            self.failIf(item.start < start)
+            self.failIf(item.end > end)
+        
+        # clamping should be kept when chaining and slicing
+        item = result.filter(id=spanning_entryitem.id)[0]
+        self.failUnlessEqual((item.start, item.end), (start, end))
+        self.failUnlessEqual((item.unclamped_start, item.unclamped_end), (spanning_entryitem.start, spanning_entryitem.end))
+        item = result.filter(id=contained_entryitem.id)[0]
+        self.failUnlessEqual((item.start, item.end), (contained_entryitem.start, contained_entryitem.end))
+
+        # stored entry items should not be changed
+        self.failUnlessEqual(EntryItem.objects.get(id=spanning_entryitem.id).start, spanning_entryitem.start)
+        EntryItem.objects.filter(id__in=[spanning_entryitem.id, contained_entryitem.id]).delete()
+    
+    def test_week_grid(self):
+        # create published calendar
+        published_cal = Calendar(title='title', state='published')
+        published_cal.save()
+        published_cal.sites.add(self.web_site)
+        published_cal.save()
+        
+        # create published content
+        content = ModelBase(title='title', state='published')
+        content.save()
+        content.sites.add(self.web_site)
+        content.save()
+        
+        date = datetime(year=2000, month=1, day=3).date()
+        start = datetime(year=2000, month=1, day=3, hour=1)
+        entry_obj = Entry(start=start, end=start + timedelta(hours=1), repeat="daily", repeat_until=(start + timedelta(days=30)).date(), content=content)
+        entry_obj.save()
+        entry_obj.calendars.add(published_cal)
+        entry_obj.save()
+
+        # create entryitem spanning the 2nd to the 4th day of the week
+        spanning_entryitem = EntryItem(entry_id=1, start=start + timedelta(days=1), end=start + timedelta(days=3), content=content)
+        spanning_entryitem.save()
+        spanning_entryitem.calendars.add(published_cal)
+
+        # should return a bucket for each day, fetched with a single query
+        connection.use_debug_cursor = True
+        start_count = len(connection.queries)
+        grid = EntryItem.permitted.week_grid(date)
+        self.failUnlessEqual(len(connection.queries) - start_count, 1)
+        connection.use_debug_cursor = False
+        
+        self.failUnlessEqual([bucket.date for bucket in grid], [date + timedelta(days=i) for i in range(7)])
+        self.failUnlessEqual([bucket.count for bucket in grid], [1, 2, 2, 2, 1, 1, 1])
+        for bucket in grid[1:4]:
+            self.failUnless(spanning_entryitem in bucket.items)
+        Entry.objects.all().delete()
+        spanning_entryitem.delete()
+
+    def test_month_grid(self):
+        # create published calendar
+        published_cal = Calendar(title='title', state='published')
+        published_cal.save()
+        published_cal.sites.add(self.web_site)
+        published_cal.save()
+        
+        # create published content
+        content = ModelBase(title='title', state='published')
+        content.save()
+        content.sites.add(self.web_site)
+        content.save()
+        
+        start = datetime(year=2000, month=12, day=1, hour=1)
+        entry_obj = Entry(start=start, end=start + timedelta(hours=1), repeat="weekly", repeat_until=(start + timedelta(days=60)).date(), content=content)
+        entry_obj.save()
+        entry_obj.calendars.add(published_cal)
+        entry_obj.save()
+
+        # should return a bucket for each day of the month
+        grid = EntryItem.permitted.month_grid(2000, 12)
+        self.failUnlessEqual(len(grid), 31)
+        self.failUnlessEqual(sum([bucket.count for bucket in grid]), 5)
+        
+        # agenda should only contain days with entry items
+        self.failUnlessEqual(len(EntryItem.permitted.agenda(start.date(), days=31)), 5)
+
+        # subsequent calls, including rendering titles and calendars, should be served from cache
+        connection.use_debug_cursor = True
+        start_count = len(connection.queries)
+        grid = EntryItem.permitted.month_grid(2000, 12)
+        self.failUnlessEqual(len(grid), 31)
+        rendered = [(unicode(item), [calendar.title for calendar in item.calendars.all()]) for bucket in grid for item in bucket.items]
+        self.failUnlessEqual(len(rendered), 5)
+        self.failUnlessEqual(len(connection.queries), start_count)
+        connection.use_debug_cursor = False
+        
+        # changes should invalidate cached grids
+        entry_obj.repeat_until = (start + timedelta(days=7)).date()
+        entry_obj.save()
+        self.failUnlessEqual(sum([bucket.count for bucket in EntryItem.permitted.month_grid(2000, 12)]), 2)
+        Entry.objects.all().delete()
+
     def test_by_date(self):
         # create published calendar
         published_cal = Calendar(title='title', state='published')
@@ -602,3 +1235,402 @@ class PermittedManagerTestCase(unittest.TestCase):
         # result should only contain the entry for the date
         result = EntryItem.permitted.by_date(date)
         self.failUnlessEqual(result.count(), 1)
+
+    def test_occurrences(self):
+        # create published calendar
+        published_cal = Calendar(title='title', state='published')
+        published_cal.save()
+        published_cal.sites.add(self.web_site)
+        published_cal.save()
+        
+        # create published content
+        content = ModelBase(title='title', state='published')
+        content.save()
+        content.sites.add(self.web_site)
+        content.save()
+        
+        settings.CAL_VIRTUAL_OCCURRENCES = True
+        try:
+            start = datetime(year=2000, month=1, day=1, hour=1, minute=1)
+            entry_obj = Entry(start=start, end=start + timedelta(hours=2), repeat="weekdays", repeat_until=(start + timedelta(days=30)).date(), content=content)
+            entry_obj.save()
+            entry_obj.calendars.add(published_cal)
+            entry_obj.save()
+
+            # no entry items should be stored in virtual mode
+            self.failIf(EntryItem.objects.filter(entry=entry_obj).count())
+
+            # occurrences should be expanded for the requested window only
+            result = EntryItem.permitted.by_range(datetime(year=2000, month=1, day=3), datetime(year=2000, month=1, day=10))
+            self.failUnlessEqual(len(result), 5)
+            for occurrence in result:
+                self.failUnlessEqual(occurrence.entry, entry_obj)
+                self.failUnlessEqual(occurrence.duration, entry_obj.duration)
+                self.failIf(occurrence.start.weekday() >= 5)
+            
+            # occurrences overlapping the start of the window should be included
+            result = EntryItem.permitted.by_range(datetime(year=2000, month=1, day=3, hour=2), datetime(year=2000, month=1, day=3, hour=4))
+            self.failUnlessEqual(len(result), 1)
+            
+            # result should only contain the occurrence for the date
+            self.failUnlessEqual(len(EntryItem.permitted.by_date(datetime(year=2000, month=1, day=4).date())), 1)
+            self.failIf(EntryItem.permitted.by_date(datetime(year=2000, month=1, day=8).date()))
+
+            # windows should expand occurrences clamped to the window
+            result = EntryItem.permitted.by_window(datetime(year=2000, month=1, day=3, hour=2), datetime(year=2000, month=1, day=4, hour=2))
+            self.failUnlessEqual([(occurrence.start, occurrence.end) for occurrence in result], [(datetime(2000, 1, 3, 2), datetime(2000, 1, 3, 3, 1)), (datetime(2000, 1, 4, 1, 1), datetime(2000, 1, 4, 2))])
+            self.failUnlessEqual(result[0].unclamped_start, datetime(2000, 1, 3, 1, 1))
+
+            # occurrences should provide entry items' attributes, but aren't stored
+            occurrence = result[0]
+            self.failUnlessEqual((occurrence.id, occurrence.pk), (None, None))
+            self.failUnlessEqual(occurrence.content_type, content.content_type)
+            self.failUnlessEqual(occurrence.occurrence_date, datetime(2000, 1, 3).date())
+        finally:
+            settings.CAL_VIRTUAL_OCCURRENCES = False
+            Entry.objects.all().delete()
+
+    def test_ical_feed(self):
+        # create published calendar
+        published_cal = Calendar(title='title', state='published')
+        published_cal.save()
+        published_cal.sites.add(self.web_site)
+        published_cal.save()
+        
+        # create published content
+        content = ModelBase(title='title; with, specials', state='published')
+        content.save()
+        content.sites.add(self.web_site)
+        content.save()
+        
+        start = datetime.now().replace(hour=1, minute=1, second=0, microsecond=0)
+        entry_obj = Entry(start=start, end=start + timedelta(hours=1), repeat="weekly", repeat_until=(start + timedelta(days=60)).date(), content=content)
+        entry_obj.save()
+        entry_obj.calendars.add(published_cal)
+        entry_obj.save()
+
+        feed = ''.join(ical.feed())
+        self.failUnless(feed.startswith('BEGIN:VCALENDAR\r\n'))
+        self.failUnless(feed.endswith('END:VCALENDAR\r\n'))
+
+        # repeating entries should be exported as a single recurring event
+        self.failUnlessEqual(feed.count('BEGIN:VEVENT'), 1)
+        self.failUnless('RRULE:FREQ=WEEKLY;UNTIL=%s' % entry_obj.repeat_until.strftime('%Y%m%dT235959') in feed)
+        self.failUnless('DTSTART:%s' % start.strftime('%Y%m%dT%H%M%S') in feed)
+        self.failUnless('SUMMARY:title\\; with\\, specials' in feed)
+        
+        # lines should be folded at 75 octets
+        for line in feed.split('\r\n'):
+            self.failIf(len(line) > 75)
+
+        # calendar feeds should only be found for calendars published on the current site
+        from django.http import Http404
+        from django.test.client import RequestFactory
+        from cal.views import ical_feed
+        request = RequestFactory().get('/')
+        self.failUnless('X-WR-CALNAME:title' in ''.join(ical_feed(request, published_cal.id)))
+        for state, sites in (('unpublished', [self.web_site]), ('staging', [self.web_site]), ('published', [])):
+            other_cal = Calendar(title='hidden', state=state)
+            other_cal.save()
+            other_cal.sites = sites
+            self.failUnlessRaises(Http404, ical_feed, request, other_cal.id)
+        Entry.objects.all().delete()
+
+    def test_import_ical(self):
+        calendar = Calendar(title='title', state='published')
+        calendar.save()
+        ics = [
+            'BEGIN:VCALENDAR\r\n',
+            'BEGIN:VEVENT\r\n',
+            'UID:weekly@example.com\r\n',
+            'DTSTART:20100104T100000\r\n',
+            'DTEND:20100104T110000\r\n',
+            'RRULE:FREQ=WEEKLY;COUNT=4\r\n',
+            'SUMMARY:folded\\, title that con\r\n',
+            ' tinues\r\n',
+            'END:VEVENT\r\n',
+            'BEGIN:VEVENT\r\n',
+            'UID:once@example.com\r\n',
+            'DTSTART;VALUE=DATE:20100110\r\n',
+            'SUMMARY:once\r\n',
+            'END:VEVENT\r\n',
+            'BEGIN:VEVENT\r\n',
+            'UID:yearly@example.com\r\n',
+            'DTSTART:20100104T100000\r\n',
+            'RRULE:FREQ=YEARLY;BYMONTH=1;BYDAY=1MO\r\n',
+            'END:VEVENT\r\n',
+            'END:VCALENDAR\r\n',
+        ]
+        result = ical.import_events(ics, calendars=[calendar])
+        self.failUnlessEqual(result['created'], 2)
+        # unsupported rules should be reported rather than imported
+        self.failUnlessEqual([uid for uid, error in result['errors']], ['yearly@example.com'])
+
+        weekly = Entry.objects.get(ical_uid='weekly@example.com')
+        self.failUnlessEqual(weekly.repeat, 'weekly')
+        self.failUnlessEqual(weekly.content.title, 'folded, title that continues')
+        self.failUnlessEqual(weekly.repeat_until, datetime(2010, 1, 25).date())
+        self.failUnlessEqual(weekly.entryitem_set.count(), 4)
+        self.failUnlessEqual(list(weekly.calendars.all()), [calendar])
+
+        once = Entry.objects.get(ical_uid='once@example.com')
+        self.failUnlessEqual(once.end - once.start, timedelta(days=1))
+
+        # re-importing should skip unchanged events, regardless of their time stamps, and update changed ones
+        ics[4] = 'DTEND:20100104T120000\r\n'
+        ics.insert(11, 'DTSTAMP:20100201T000000Z\r\n')
+        result = ical.import_events(ics, calendars=[calendar])
+        self.failUnlessEqual((result['created'], result['updated'], result['skipped']), (0, 1, 1))
+        self.failUnlessEqual(Entry.objects.filter(ical_uid='weekly@example.com').count(), 1)
+        for item in Entry.objects.get(ical_uid='weekly@example.com').entryitem_set.all():
+            self.failUnlessEqual(item.end - item.start, timedelta(hours=2))
+
+        # malformed and invalid events should only fail themselves, without leaving content behind
+        content_count = ModelBase.objects.count()
+        result = ical.import_events([
+            'BEGIN:VCALENDAR\r\n',
+            'BEGIN:VEVENT\r\n',
+            'UID:malformed@example.com\r\n',
+            'DTSTART:20100104T100000\r\n',
+            'DESCRIPTION badly folded\r\n',
+            'END:VEVENT\r\n',
+            'BEGIN:VEVENT\r\n',
+            'UID:endless@example.com\r\n',
+            'DTSTART:20100104T100000\r\n',
+            'RRULE:FREQ=DAILY\r\n',
+            'END:VEVENT\r\n',
+            'BEGIN:VEVENT\r\n',
+            'UID:valid@example.com\r\n',
+            'DTSTART:20100104T100000\r\n',
+            'END:VEVENT\r\n',
+            'END:VCALENDAR\r\n',
+        ], calendars=[calendar])
+        self.failUnlessEqual(result['created'], 1)
+        self.failUnlessEqual([uid for uid, error in result['errors']], ['malformed@example.com', 'endless@example.com'])
+        self.failUnlessEqual(ModelBase.objects.count(), content_count + 1)
+        Entry.objects.all().delete()
+
+    def test_freebusy(self):
+        # create published calendars
+        busy_cal = Calendar(title='title', state='published')
+        busy_cal.save()
+        busy_cal.sites.add(self.web_site)
+        busy_cal.save()
+        free_cal = Calendar(title='title', state='published')
+        free_cal.save()
+        free_cal.sites.add(self.web_site)
+        free_cal.save()
+        
+        # create published content
+        content = ModelBase(title='title', state='published')
+        content.save()
+        content.sites.add(self.web_site)
+        content.save()
+
+        start = datetime(2010, 1, 1, 8)
+        end = datetime(2010, 1, 1, 18)
+        for item_start, item_end in [(7, 9), (10, 12), (11, 13), (13, 14), (16, 20)]:
+            entry_obj = Entry(start=start.replace(hour=item_start), end=start.replace(hour=item_end), repeat="does_not_repeat", content=content)
+            entry_obj.save()
+            entry_obj.calendars.add(busy_cal)
+            entry_obj.save()
+
+        result = EntryItem.permitted.freebusy(start, end, calendars=[busy_cal, free_cal])
+
+        # overlapping and touching entry items should be merged and clamped to the window
+        self.failUnlessEqual(result[busy_cal.id]['busy'], [(start, start.replace(hour=9)), (start.replace(hour=10), start.replace(hour=14)), (start.replace(hour=16), end)])
+        self.failUnlessEqual(result[busy_cal.id]['free'], [(start.replace(hour=9), start.replace(hour=10)), (start.replace(hour=14), start.replace(hour=16))])
+        
+        # calendars without entry items should be entirely free
+        self.failUnlessEqual(result[free_cal.id], {'busy': [], 'free': [(start, end)]})
+        Entry.objects.all().delete()
+
+    def test_conflicts(self):
+        calendar = Calendar(title='title')
+        calendar.save()
+        other_calendar = Calendar(title='title')
+        other_calendar.save()
+        content = ModelBase(title='title')
+        content.save()
+
+        start = datetime(2010, 1, 4, 10)
+        daily = Entry(start=start, end=start + timedelta(hours=1), repeat="daily", repeat_until=datetime(2010, 1, 10).date(), content=content)
+        daily.save()
+        daily.calendars.add(calendar)
+        daily.save()
+        
+        # entries on other calendars or merely touching don't conflict
+        touching = Entry(start=start + timedelta(hours=1), end=start + timedelta(hours=2), repeat="does_not_repeat", content=content)
+        self.failUnlessEqual(touching.conflicts(calendars=[calendar]), [])
+        overlapping = Entry(start=start + timedelta(days=2, minutes=30), end=start + timedelta(days=2, hours=2), repeat="weekly", repeat_until=datetime(2010, 1, 31).date(), content=content)
+        self.failUnlessEqual(overlapping.conflicts(calendars=[other_calendar]), [])
+        
+        conflicts = overlapping.conflicts(calendars=[calendar])
+        self.failUnlessEqual([item.start for item in conflicts], [start + timedelta(days=2)])
+        
+        # saving should be refused when checking for conflicts
+        overlapping.save()
+        overlapping.calendars.add(calendar)
+        overlapping.save()
+        self.failUnlessRaises(models.ConflictError, overlapping.save, check_conflicts=True)
+
+        # new entries should be checked against the calendars they're saved with
+        single = Entry(start=start + timedelta(minutes=30), end=start + timedelta(hours=2), repeat="does_not_repeat", content=content)
+        self.failUnlessRaises(models.ConflictError, single.save, check_conflicts=True, calendars=[calendar])
+        self.failIf(single.pk)
+        single.save(check_conflicts=True, calendars=[other_calendar])
+        self.failUnlessEqual(list(single.entryitem_set.get().calendars.all()), [other_calendar])
+
+        # the admin should report conflicts with submitted calendars as form errors
+        from cal.admin import EntryAdminForm
+        settings.CAL_CHECK_CONFLICTS = True
+        try:
+            data = {'start': '2010-01-05 10:30:00', 'end': '2010-01-05 11:30:00', 'repeat': 'does_not_repeat', 'content': content.id, 'calendars': [calendar.id]}
+            self.failIf(EntryAdminForm(data).is_valid())
+            data['calendars'] = [other_calendar.id]
+            self.failUnless(EntryAdminForm(data).is_valid())
+        finally:
+            settings.CAL_CHECK_CONFLICTS = False
+        
+        # queryset conflicts should report each overlapping pair once
+        result = EntryItemQuerySet(EntryItem).conflicts(start, start + timedelta(days=30))
+        self.failUnlessEqual(len(result), 1)
+        self.failUnlessEqual(result[0][0], calendar.id)
+        Entry.objects.all().delete()
+
+    def test_occurrence_index(self):
+        settings.CAL_OCCURRENCE_INDEX = True
+        try:
+            # create published calendar
+            published_cal = Calendar(title='title', state='published')
+            published_cal.save()
+            published_cal.sites.add(self.web_site)
+            published_cal.save()
+            
+            # create published content
+            content = ModelBase(title='title', state='published')
+            content.save()
+            content.sites.add(self.web_site)
+            content.save()
+
+            start = datetime(2010, 1, 4, 10)
+            entry_obj = Entry(start=start, end=start + timedelta(hours=1), repeat="daily", repeat_until=datetime(2010, 1, 10).date(), content=content)
+            entry_obj.save()
+            entry_obj.calendars.add(published_cal)
+            entry_obj.save()
+            
+            index = EntryItem.permitted.index()
+            self.failUnlessEqual([record.start for record in index.by_date(datetime(2010, 1, 5).date())], [datetime(2010, 1, 5, 10)])
+            self.failUnlessEqual(set(index.ids(datetime(2010, 1, 1), datetime(2010, 2, 1))), set(EntryItem.permitted.by_range(datetime(2010, 1, 1), datetime(2010, 2, 1)).values_list('id', flat=True)))
+
+            # changes should be applied incrementally on refresh
+            entry_obj.start = start + timedelta(hours=2)
+            entry_obj.end = start + timedelta(hours=3)
+            entry_obj.repeat_until = datetime(2010, 1, 7).date()
+            entry_obj.save()
+            index.refresh()
+            self.failUnlessEqual([record.start for record in index.by_range(datetime(2010, 1, 1), datetime(2010, 2, 1))], [datetime(2010, 1, day, 12) for day in range(4, 8)])
+            
+            # unpublished items should drop out of the index
+            content.state = 'unpublished'
+            content.save()
+            index.refresh()
+            self.failUnlessEqual(index.by_range(datetime(2010, 1, 1), datetime(2010, 2, 1)), [])
+
+            # changes to more items than fit in a single query should reload the index
+            content.state = 'published'
+            content.save()
+            entry_obj.repeat_until = datetime(2013, 1, 1).date()
+            entry_obj.save()
+            index.refresh()
+            entry_obj.start = entry_obj.start + timedelta(hours=1)
+            entry_obj.end = entry_obj.end + timedelta(hours=1)
+            entry_obj.save()
+            index.refresh()
+            records = index.by_range(datetime(2010, 1, 1), datetime(2013, 2, 1))
+            self.failUnlessEqual(len(records), entry_obj.entryitem_set.count())
+            self.failUnless(len(records) > 1000)
+            self.failUnlessEqual(set([record.start.hour for record in records]), set([13]))
+        finally:
+            settings.CAL_OCCURRENCE_INDEX = False
+        Entry.objects.all().delete()
+
+    def test_listing(self):
+        # create published calendar
+        published_cal = Calendar(title='title', state='published')
+        published_cal.save()
+        published_cal.sites.add(self.web_site)
+        published_cal.save()
+        
+        # create published content
+        content = ModelBase(title='title', state='published')
+        content.save()
+        content.sites.add(self.web_site)
+        content.save()
+
+        query_counts = []
+        for days in (3, 30):
+            entry_obj = Entry(start=datetime(2010, 1, 1, 10), end=datetime(2010, 1, 1, 11), repeat="daily", repeat_until=(datetime(2010, 1, 1) + timedelta(days=days - 1)).date(), content=content)
+            entry_obj.save()
+            entry_obj.calendars.add(published_cal)
+            entry_obj.save()
+
+            # rendering items with their content and calendars should cost a constant number of queries
+            connection.use_debug_cursor = True
+            start_count = len(connection.queries)
+            rendered = [(unicode(item), item.entry.repeat, [calendar.title for calendar in item.calendars.all()]) for item in EntryItem.permitted.listing().filter(entry=entry_obj)]
+            query_counts.append(len(connection.queries) - start_count)
+            connection.use_debug_cursor = False
+            self.failUnlessEqual(len(rendered), days)
+            entry_obj.delete()
+
+        self.failUnlessEqual(query_counts[0], query_counts[1])
+
+    def test_search_tokens(self):
+        content = ModelBase(title='Morning Show', description='News, weather & traffic')
+        content.save()
+        entry_obj = Entry(start=datetime(2010, 1, 1, 6), end=datetime(2010, 1, 1, 9), repeat="does_not_repeat", content=content)
+        entry_obj.save()
+        self.failUnlessEqual(set(entry_obj.searchtoken_set.values_list('token', flat=True)), set(['morning', 'show', 'news', 'weather', 'traffic']))
+        
+        # tokens should follow content changes
+        content.title = 'Breakfast Show'
+        content.save()
+        self.failUnlessEqual(set(entry_obj.searchtoken_set.values_list('token', flat=True)), set(['breakfast', 'show', 'news', 'weather', 'traffic']))
+
+        # admin counts should be exact for small result sets
+        from cal.admin import approximate_count
+        self.failUnlessEqual(approximate_count(Entry.objects.filter(searchtoken_set__token='breakfast')), 1)
+        self.failUnlessEqual(approximate_count(Entry.objects.filter(id__in=[])), 0)
+        entry_obj.delete()
+
+    def test_admin_changelist(self):
+        from django.contrib import admin
+        from django.test.client import RequestFactory
+        from cal.admin import ApproximateCountPaginator, EntryAdmin, EntryChangeList
+        from django.core.paginator import EmptyPage
+
+        content = ModelBase(title='title')
+        content.save()
+        for day in range(1, 13):
+            Entry(start=datetime(2010, 1, day, 10), end=datetime(2010, 1, day, 11), repeat="does_not_repeat", content=content).save()
+
+        # pages of filtered results beyond the count limit should be reachable
+        settings.CAL_ADMIN_COUNT_LIMIT = 5
+        try:
+            model_admin = EntryAdmin(Entry, admin.site)
+            request = RequestFactory().get('/', {'p': '5', 'repeat__exact': 'does_not_repeat'})
+            changelist = EntryChangeList(request, Entry, model_admin.list_display, model_admin.list_display_links, model_admin.list_filter,
+                model_admin.date_hierarchy, model_admin.search_fields, model_admin.list_select_related, 2, model_admin.list_max_show_all,
+                model_admin.list_editable, model_admin)
+            self.failUnlessEqual(changelist.result_count, 12)
+            self.failUnlessEqual([entry.start.day for entry in changelist.result_list], [11, 12])
+
+            # as should pages beyond a count estimated too low, while they contain objects
+            paginator = ApproximateCountPaginator(Entry.objects.order_by('start'), 2)
+            paginator._count = 5
+            self.failUnlessEqual([entry.start.day for entry in paginator.page(6).object_list], [11, 12])
+            self.failUnlessRaises(EmptyPage, paginator.page, 7)
+        finally:
+            settings.CAL_ADMIN_COUNT_LIMIT = 10000
+        Entry.objects.all().delete()
@@ -0,0 +1,6 @@
+from django.conf.urls.defaults import patterns, url
+
+urlpatterns = patterns('cal.views',
+    url(r'^ical/$', 'ical_feed', name='cal_ical_feed'),
+    url(r'^ical/(?P<calendar_id>\d+)/$', 'ical_feed', name='cal_calendar_ical_feed'),
+)
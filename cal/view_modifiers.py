@@ -1,26 +1,54 @@
 import calendar
 from datetime import datetime, timedelta
 
+from cal.managers import virtual_mode
 from panya.view_modifiers import ViewModifier
 from panya.view_modifiers.items import GetItem
 
+def check_virtual(queryset):
+    """
+    Raises an error for querysets of stored entry items in virtual mode, as none are stored.
+    """
+    if virtual_mode() and not hasattr(queryset, 'occurrences'):
+        raise Exception("No entry items are stored with settings.CAL_VIRTUAL_OCCURRENCES = True, provide EntryItem.permitted instead of a queryset.")
+
 class EntryByWeekdayItem(GetItem):
-    def __init__(self, request, title, get, date, default):
+    def __init__(self, request, title, get, date, default, bucket=None):
         self.date=date
+        # entry items for date as fetched for the whole week, see EntriesByWeekdaysViewModifier
+        self.bucket=bucket
         super(EntryByWeekdayItem, self).__init__(request=request, title=title, get=get, default=default)
 
+    @property
+    def entries(self):
+        return self.bucket.items if self.bucket else []
+
+    @property
+    def count(self):
+        return self.bucket.count if self.bucket else 0
+
     def modify(self, view):
+        check_virtual(view.params['queryset'])
         view.params['queryset'] = view.params['queryset'].by_date(self.date)
         return view
 
 class EntriesByWeekdaysViewModifier(ViewModifier):
-    def __init__(self, request, *args, **kwargs):
+    def __init__(self, request, queryset=None, *args, **kwargs):
+        """
+        Providing a queryset (or manager) of entry items fetches the whole week with a
+        single query, making each day's entries and count available on its item.
+        """
         self.items = []
         now = datetime.now().date()
         
         day_names = [name for name in calendar.day_abbr]
         current_day = day_names[now.weekday()]
 
+        buckets_by_day = {}
+        if queryset is not None:
+            check_virtual(queryset)
+            for bucket in queryset.week_grid(now):
+                buckets_by_day[day_names[bucket.date.weekday()]] = bucket
         
         dates_by_day = {}
         date = now
@@ -35,6 +63,7 @@ class EntriesByWeekdaysViewModifier(ViewModifier):
                 get={'name': 'day', 'value': name},
                 date=dates_by_day[name],
                 default=current_day==name,
+                bucket=buckets_by_day.get(name),
             ))
             
         super(EntriesByWeekdaysViewModifier, self).__init__(request)
@@ -0,0 +1,17 @@
+from django.http import HttpResponse
+from django.shortcuts import get_object_or_404
+
+from cal import ical
+
+def ical_feed(request, calendar_id=None):
+    """
+    Streams permitted upcoming entries, optionally for a single calendar, as an iCalendar feed.
+    Calendars not published on the current site aren't found.
+    """
+    entries = ical.permitted_entries()
+    name = None
+    if calendar_id is not None:
+        calendar = get_object_or_404(ical.permitted_calendars(), id=calendar_id)
+        entries = entries.filter(calendars=calendar)
+        name = calendar.title
+    return HttpResponse(ical.feed(entries, name=name), mimetype='text/calendar; charset=utf-8')